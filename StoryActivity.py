@@ -57,6 +57,9 @@ SERVICE = 'org.sugarlabs.StoryActivity'
 IFACE = SERVICE
 PATH = '/org/sugarlabs/StoryActivity'
 
+# Set to 1 to log drawing measurements on close, or to a file to save them
+RENDER_STATS = os.environ.get('STORY_RENDER_STATS')
+
 
 class StoryActivity(activity.Activity):
     ''' Storytelling game '''
@@ -81,7 +84,7 @@ class StoryActivity(activity.Activity):
 
         self.tablet_mode = _is_tablet_mode()
         self.recording = False
-        self.audio_process = None
+        self._audio_notes = None  # Journal audio notes, once looked up
         self._arecord = None
         self._alert = None
         self._uid = None
@@ -149,6 +152,8 @@ class StoryActivity(activity.Activity):
 
         self._game = Game(self._canvas, parent=self, path=self._path,
                           root=activity.get_bundle_path(), colors=self._colors)
+        if RENDER_STATS:
+            self._game.enable_render_stats()
         self._setup_presence_service()
 
         if 'mode' in self.metadata:
@@ -176,8 +181,22 @@ class StoryActivity(activity.Activity):
 
     def close(self, **kwargs):
         aplay.close()
+        self._dump_render_stats()
         activity.Activity.close(self, **kwargs)
 
+    def _dump_render_stats(self):
+        report = self._game.render_stats()
+        if report is None:
+            return
+        if RENDER_STATS == '1':
+            _logger.info('render stats:\n%s' % report)
+            return
+        try:
+            with open(RENDER_STATS, 'a') as fd:
+                fd.write(report + '\n')
+        except OSError as e:
+            _logger.error('render stats %s: %s' % (RENDER_STATS, e))
+
     def _configure_cb(self, event):
         self._canvas.set_size_request(int(Gdk.Screen.width()),
                                       int(Gdk.Screen.height()))
@@ -247,6 +266,7 @@ class StoryActivity(activity.Activity):
                 self.metadata[key] = text
                 self.metadata['dirty'] = 'True'
                 self._game.set_speak_icon_state(True)
+                self._game.prepare_speech(text)
             else:
                 self._game.set_speak_icon_state(False)
 
@@ -308,8 +328,19 @@ class StoryActivity(activity.Activity):
                 dsobject.metadata['tags'] = ''
                 datastore.write(dsobject)
                 dsobject.destroy()
+        self._audio_notes = None
         self._game.set_play_icon_state(False)
 
+    def page_texts(self):
+        ''' The text written for each page in linear mode '''
+        texts = []
+        for i in range(9):
+            text = self.metadata.get('text-%d' % i, '')
+            if text and text not in [PLACEHOLDER, PLACEHOLDER1,
+                                     PLACEHOLDER2]:
+                texts.append(text)
+        return texts
+
     def check_audio_status(self):
         if self._search_for_audio_note(self._uid):
             self._game.set_play_icon_state(True)
@@ -439,7 +470,9 @@ class StoryActivity(activity.Activity):
     def _search_for_audio_note(self, obj_id, target=None):
         ''' Look to see if there is already a sound recorded for this
         dsobject: the object id is stored in a tag in the audio file. '''
-        dsobjects, nobjects = datastore.find({'mime_type': ['audio/ogg']})
+        if self._audio_notes is None:
+            self._audio_notes, nobjects = datastore.find(
+                {'mime_type': ['audio/ogg']})
         # Look for tag that matches the target object id
         if target is None:
             if self._game.get_mode() == 'array':
@@ -447,7 +480,7 @@ class StoryActivity(activity.Activity):
             else:
                 target = '%s-%d' % (obj_id, self._game.current_image)
 
-        for dsobject in dsobjects:
+        for dsobject in self._audio_notes:
             if 'tags' in dsobject.metadata and \
                target in dsobject.metadata['tags']:
                 _logger.debug('Found audio note')
@@ -538,20 +571,30 @@ class StoryActivity(activity.Activity):
             cb()
         return False  # do not call back
 
-    def playback_recording_cb(self, button=None):
+    def playback_recording_cb(self, button=None, finished_cb=None):
         ''' Play back current recording '''
         if self.recording:  # Stop recording if we happen to be recording
-            self.record_cb(cb=self._playback_recording)
+            self.record_cb(
+                cb=lambda: self._playback_recording(finished_cb))
         else:
-            self._playback_recording()
+            self._playback_recording(finished_cb)
 
-    def _playback_recording(self):
+    def _playback_recording(self, finished_cb=None):
         path = os.path.join(self.datapath, 'output.ogg')
         if self._uid is not None:
             dsobject = self._search_for_audio_note(self._uid)
             if dsobject is not None:
                 path = dsobject.file_path
-        aplay.play(path)
+        aplay.play(path, finished_cb)
+
+    def preroll_recording(self, page):
+        ''' Get the recording for a page ready to play '''
+        if self._uid is None:
+            return
+        dsobject = self._search_for_audio_note(
+            self._uid, target='%s-%d' % (self._uid, page))
+        if dsobject is not None:
+            aplay.preroll(dsobject.file_path)
 
     def _save_recording(self):
         self.metadata['dirty'] = 'True'  # So we know that we've done work
@@ -578,6 +621,7 @@ class StoryActivity(activity.Activity):
             dsobject.set_file_path(os.path.join(self.datapath, 'output.ogg'))
             datastore.write(dsobject)
             dsobject.destroy()
+            self._audio_notes = None
 
             # Enable playback after record is finished
             self._game.set_play_icon_state(True)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026 Sugar Labs
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+'''
+animation.py steps through a fixed number of frames on a widget's frame
+clock. Steps are timed from the frame clock, so a slow frame skips ahead
+rather than stretching the animation. The frame clock stops while the
+widget is not mapped, so an animation on a hidden widget goes straight to
+its end.
+
+Example usage:
+        def step(n):
+            sprite.set_shape(frames[n % len(frames)])
+
+        self._animation = Animation(canvas, 500, 10, step, self._done)
+        self._animation.start()
+        ...
+        self._animation.cancel()
+'''
+
+FRAME = 16  # ms, a step on every frame at 60 frames a second
+
+
+class Animation:
+    ''' A frame-clock driven sequence of steps '''
+
+    def __init__(self, widget, interval, steps, step_cb, done_cb=None):
+        ''' Call step_cb(n) every interval ms for n in range(steps), then
+        done_cb() '''
+        self._widget = widget
+        self._interval = interval * 1000  # frame time is in microseconds
+        self._steps = steps
+        self._step_cb = step_cb
+        self._done_cb = done_cb
+        self._tick_id = None
+        self._unmap_id = None
+        self._start_time = None
+        self._step = -1
+
+    def start(self):
+        ''' Start (or restart) the animation '''
+        self.cancel()
+        self._start_time = None
+        self._step = -1
+        if not self._widget.get_mapped():
+            self._done()
+            return
+        self._tick_id = self._widget.add_tick_callback(self._tick)
+        self._unmap_id = self._widget.connect('unmap', self._unmap_cb)
+
+    def cancel(self):
+        ''' Stop without calling done_cb '''
+        if self._tick_id is not None:
+            self._widget.remove_tick_callback(self._tick_id)
+            self._tick_id = None
+        if self._unmap_id is not None:
+            self._widget.disconnect(self._unmap_id)
+            self._unmap_id = None
+
+    def finish(self):
+        ''' Stop now and call done_cb, as if the last step had passed '''
+        if self.is_running():
+            self.cancel()
+            self._done()
+
+    def is_running(self):
+        return self._tick_id is not None
+
+    def _unmap_cb(self, widget):
+        self.finish()
+
+    def _done(self):
+        if self._done_cb is not None:
+            self._done_cb()
+
+    def _tick(self, widget, frame_clock):
+        now = frame_clock.get_frame_time()
+        if self._start_time is None:
+            self._start_time = now
+        step = int((now - self._start_time) / self._interval)
+        if step == self._step:
+            return True
+        if step >= self._steps:
+            self._tick_id = None  # returning False removes the callback
+            self.cancel()
+            self._done()
+            return False
+        self._step = step
+        self._step_cb(step)
+        return True
@@ -16,57 +16,188 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import logging
-from queue import Queue
+import time
+from collections import deque
 import gi
 gi.require_version('Gst', '1.0')
-from gi.repository import Gst
+from gi.repository import GObject, Gst
 
 
 Gst.init(None)
 
+# States of the player
+IDLE = 'idle'
+PREROLLING = 'prerolling'  # asked to play, not PLAYING yet
+PLAYING = 'playing'
+PAUSED = 'paused'
+
+
+class Aplay(GObject.GObject):
+    ''' Plays files one after another without ever waiting on GStreamer;
+    state changes are followed through messages on the bus '''
+
+    started = GObject.Signal('started', arg_types=[str])
+    finished = GObject.Signal('finished', arg_types=[str])
+    error = GObject.Signal('error', arg_types=[str, str])
 
-class Aplay:
     def __init__(self):
-        pipeline = Gst.ElementFactory.make('playbin', 'playbin')
+        GObject.GObject.__init__(self)
+        self.state = IDLE
+        self._pipeline = self._make_pipeline()
+        self._spare = None  # a second pipeline, prerolled in PAUSED
+        self._spare_name = None
+        self._queue = deque()
+        self._name = None
+        self._finished_cb = None
+        self._requested = None  # when the current file was asked for
+        # ms from asking for a file to its pipeline reaching PLAYING, most
+        # recent last
+        self.start_times = deque(maxlen=50)
+
+    def _make_pipeline(self):
+        pipeline = Gst.ElementFactory.make('playbin', None)
         pipeline.set_property(
             "video-sink",
-            Gst.ElementFactory.make('fakesink', 'fakesink'))
+            Gst.ElementFactory.make('fakesink', None))
 
         bus = pipeline.get_bus()
         bus.add_signal_watch()
-        bus.connect('message::eos', self._on_message_eos)
-        bus.connect('message::error', self._on_message_error)
-
-        self._pipeline = pipeline
-        self._queue = Queue()
+        bus.connect('message::eos', self._on_message_eos, pipeline)
+        bus.connect('message::error', self._on_message_error, pipeline)
+        bus.connect('message::state-changed', self._on_message_state_changed,
+                    pipeline)
+        return pipeline
 
     def _dequeue(self):
-        if self._queue.empty():
+        if self.state != IDLE or not self._queue or self._pipeline is None:
             return
-        name = self._queue.get()
-        self._pipeline.props.uri = 'file://' + name
+        self._name, self._finished_cb = self._queue.popleft()
+        if self._spare is not None and self._name == self._spare_name:
+            # Already prerolled, so it starts without a gap
+            self._pipeline, self._spare = self._spare, self._pipeline
+            self._spare_name = None
+        else:
+            self._pipeline.props.uri = 'file://' + self._name
+        self.state = PREROLLING
+        self._requested = time.time()
         self._pipeline.set_state(Gst.State.PLAYING)
 
-    def _on_message_eos(self, bus, message):
-        if self._pipeline:
-            self._pipeline.set_state(Gst.State.NULL)
-            self._dequeue()
+    def preroll(self, name):
+        ''' Load a file into a paused second pipeline, so that playing it
+        next starts straight away '''
+        if name == self._spare_name or self._pipeline is None:
+            return
+        if self._spare is None:
+            self._spare = self._make_pipeline()
+        self._spare.set_state(Gst.State.NULL)
+        self._spare.props.uri = 'file://' + name
+        self._spare_name = name
+        self._spare.set_state(Gst.State.PAUSED)
+
+    def _finished(self):
+        self.state = IDLE
+        name, self._name = self._name, None
+        finished_cb, self._finished_cb = self._finished_cb, None
+        self._requested = None
+        if finished_cb is not None:
+            finished_cb()
+        return name
+
+    def _on_message_state_changed(self, bus, message, pipeline):
+        if pipeline is not self._pipeline or message.src != pipeline:
+            return
+        old, new, pending = message.parse_state_changed()
+        if new != Gst.State.PLAYING or self.state != PREROLLING:
+            return
+        self.state = PLAYING
+        if self._requested is not None:  # not just resumed
+            ms = (time.time() - self._requested) * 1000
+            self._requested = None
+            self.start_times.append(ms)
+            logging.debug('%s: playing after %.1f ms', self._name, ms)
+            self.emit('started', self._name)
+
+    def _on_message_eos(self, bus, message, pipeline):
+        if pipeline is not self._pipeline or self.state == IDLE:
+            return
+        self._pipeline.set_state(Gst.State.NULL)
+        self.emit('finished', self._finished())
+        self._dequeue()
 
-    def _on_message_error(self, bus, message):
+    def _on_message_error(self, bus, message, pipeline):
         err, debug = message.parse_error()
         logging.error('%s %s', err, debug)
-        self._pipeline.set_state(Gst.State.NULL)
+        pipeline.set_state(Gst.State.NULL)
+        if pipeline is not self._pipeline:  # the preroll failed
+            self._spare_name = None
+            return
+        if self.state == IDLE:
+            return
+        self.emit('error', self._finished(), str(err))
         self._dequeue()
 
-    def play(self, name):
-        self._queue.put(name)
+    def is_playing(self):
+        return self.state in (PREROLLING, PLAYING)
+
+    def pause(self):
+        if self.state in (PREROLLING, PLAYING):
+            self._pipeline.set_state(Gst.State.PAUSED)
+            self.state = PAUSED
+
+    def resume(self):
+        if self.state == PAUSED:
+            self.state = PREROLLING
+            self._pipeline.set_state(Gst.State.PLAYING)
+
+    def seek(self, seconds):
+        ''' Jump to a time in the current file; returns False if the
+        pipeline cannot seek (yet) '''
+        if self.state == IDLE:
+            return False
+        return self._pipeline.seek_simple(
+            Gst.Format.TIME, Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT,
+            int(seconds * Gst.SECOND))
+
+    def position(self):
+        ''' Seconds into the current file, or None if it is not known '''
+        if self.state == IDLE:
+            return None
+        ok, position = self._pipeline.query_position(Gst.Format.TIME)
+        return position / Gst.SECOND if ok else None
+
+    def duration(self):
+        ''' Length of the current file in seconds, or None if it is not
+        known yet '''
+        if self.state == IDLE:
+            return None
+        ok, duration = self._pipeline.query_duration(Gst.Format.TIME)
+        return duration / Gst.SECOND if ok else None
+
+    def stop(self):
+        ''' Stop playing and forget anything queued, without calling
+        back '''
+        self._queue.clear()
+        self._name = None
+        self._finished_cb = None
+        self._requested = None
+        self.state = IDLE
         if self._pipeline:
-            if self._pipeline.get_state(Gst.CLOCK_TIME_NONE)[1] == Gst.State.NULL:
-                self._dequeue()
+            self._pipeline.set_state(Gst.State.NULL)
+        if self._spare is not None:
+            self._spare.set_state(Gst.State.NULL)
+            self._spare_name = None
+
+    def play(self, name, finished_cb=None):
+        ''' Play a file after any already queued; finished_cb() is called
+        at the end of the stream, or if it cannot be played '''
+        self._queue.append((name, finished_cb))
+        if self.state == IDLE:
+            self._dequeue()
 
     def close(self):
-        self._pipeline.set_state(Gst.State.NULL)
+        self.stop()
         self._pipeline = None
+        self._spare = None
 
 
 aplay = Aplay()
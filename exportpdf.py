@@ -115,7 +115,7 @@ def page(activity, cr, fd, body, text, page_width, page_height):
     cr.save()
     cr.scale(0.67, 0.67)
     cr.set_source_surface(
-        activity._game._Dots[activity._game.current_image].images[0], x, y)
+        activity._game.page_surface(activity._game.current_image), x, y)
     cr.rectangle(x, y, w, h)
     cr.fill()
     cr.restore()
@@ -12,12 +12,15 @@
 # along with this library; if not, write to the Free Software
 # Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
 
-from gi.repository import Gdk, GdkPixbuf, Gtk, GObject
+import gi
+gi.require_version('Rsvg', '2.0')
+from gi.repository import Gdk, GdkPixbuf, Gtk, GObject, Rsvg
 
 import cairo
 import os
 import glob
 import time
+import threading
 from itertools import islice
 from random import uniform
 
@@ -35,8 +38,15 @@ try:
 except ImportError:
     pass
 
+from animation import Animation
+from iconatlas import IconAtlas
 from sprites import Sprites, Sprite
-from utils import speak
+from speech import speech
+from speechcache import SpeechCache
+from svgtemplates import templates
+from tilecache import TileCache, tile_key, surface_cache
+from aplay import aplay
+from utils import speak, get_voice
 
 PREV = 0
 NEXT = 1
@@ -50,22 +60,41 @@ PLAY_ON = 1
 SPEAK_OFF = 0
 SPEAK_ON = 1
 
+ICONS = ['media-audio', 'media-audio-recording', 'play-inactive', 'play',
+         'speak-inactive', 'speak', 'go-previous', 'go-next',
+         'go-previous-inactive', 'go-next-inactive']
+
 DOT_SIZE = 40
+PAGE_WINDOW = 1  # pages kept rendered either side of the current page
+MIN_DWELL = 5000  # ms each page is shown for during autoplay, at least
+PAGE_GAP = 500  # ms of quiet between pages during autoplay
 COLORS = ['#000000', '#a00000', '#907000', '#009000', '#0000ff', '#9000a0']
 
 
 class Game():
 
     def __init__(self, canvas, parent=None, path=None, root=None, mode='array',
-                 colors=['#A0FFA0', '#FF8080']):
+                 colors=['#A0FFA0', '#FF8080'], async_load=True):
         self._canvas = canvas
+        self._scale_factor = canvas.get_scale_factor()
+        self.async_load = async_load
+        self._load_generation = 0
+        self._loaded = set()  # pages whose pictures have been rendered
+        self._materialized = set()  # pages holding their large surface
+        self._prefetch_id = None
+        # Large surfaces of pages outside the window are swapped for this
+        self._released_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                                    1, 1)
         self._parent = parent
         self._path = path
         self._root = root
         self._mode = mode
         self.current_image = 0
         self.playing = False
+        self.min_dwell = MIN_DWELL
+        self.page_gap = PAGE_GAP
         self._timeout_id = None
+        self._sound_id = 0  # so that late callbacks can be ignored
         self._prev_mouse_pos = (0, 0)
         self._start_time = 0
 
@@ -90,52 +119,28 @@ class Game():
         self._start_time = 0
         self._timeout_id = None
 
+        # Short animation before loading a new game
+        self._dance = Animation(self._canvas, 500, 10, self._dance_step,
+                                self._new_images)
+        self._dance_frames = {}
+
         # Find the image files
         self._PATHS = glob.glob(os.path.join(self._path, 'images', '*.svg'))
+        templates.preload([self._image_path(i)
+                           for i in range(len(self._PATHS))])
+
+        # Rendered tiles persist in the instance directory between sessions
+        self._tile_cache = TileCache(
+            os.path.join(self._parent.datapath, 'tiles.cache'))
+        self._speech_cache = SpeechCache(
+            os.path.join(self._parent.datapath, 'speech'))
+        speech.set_cache(self._speech_cache)
 
         # Generate the sprites we'll need...
         self._sprites = Sprites(self._canvas)
-
-        a = max(Gdk.Screen.width(), Gdk.Screen.height())
-        b = min(Gdk.Screen.width(), Gdk.Screen.height())
-        self._bg_pixbufs = []
-        if self._parent.tablet_mode:  # text on top
-            # landscape
-            self._bg_pixbufs.append(svg_str_to_pixbuf(genhole(
-                a, a,
-                3 * style.GRID_CELL_SIZE,
-                style.DEFAULT_SPACING,
-                a - 3 * style.GRID_CELL_SIZE,
-                style.GRID_CELL_SIZE * 3 + style.DEFAULT_SPACING)))
-            # portrait
-            self._bg_pixbufs.append(svg_str_to_pixbuf(genhole(
-                a, a,
-                3 * style.GRID_CELL_SIZE,
-                style.DEFAULT_SPACING,
-                b - 3 * style.GRID_CELL_SIZE,
-                style.GRID_CELL_SIZE * 3 + style.DEFAULT_SPACING)))
-        else:  # text on bottom
-            # landscape
-            self._bg_pixbufs.append(svg_str_to_pixbuf(genhole(
-                a, a,
-                3 * style.GRID_CELL_SIZE,
-                b - style.GRID_CELL_SIZE * 4 - style.DEFAULT_SPACING,
-                a - 3 * style.GRID_CELL_SIZE,
-                b - style.GRID_CELL_SIZE - style.DEFAULT_SPACING)))
-            # portrait
-            self._bg_pixbufs.append(svg_str_to_pixbuf(genhole(
-                a, a,
-                3 * style.GRID_CELL_SIZE,
-                a - style.GRID_CELL_SIZE * 4 - style.DEFAULT_SPACING,
-                b - 3 * style.GRID_CELL_SIZE,
-                a - style.GRID_CELL_SIZE - style.DEFAULT_SPACING)))
-
-        if Gdk.Screen.width() > Gdk.Screen.height():
-            self._bg = Sprite(self._sprites, 0, 0, self._bg_pixbufs[0])
-        else:
-            self._bg = Sprite(self._sprites, 0, 0, self._bg_pixbufs[1])
-        self._bg.set_layer(-2)
-        self._bg.type = 'background'
+        # The background and the icons rarely change, so they are kept
+        # in an offscreen surface.
+        self._sprites.set_retained_layer(1, self._draw_background)
 
         size = 3 * self._dot_size + 4 * self._space
         x = int((Gdk.Screen.width() - size) / 2.)
@@ -174,26 +179,22 @@ class Game():
             self._art4apps = Art4Apps()
             self.number_of_images = len(self._art4apps.get_words())
 
+        # All of the icons are rendered once into a cached atlas
+        self._atlas = IconAtlas(
+            os.path.join(self._root, 'icons'), self._parent.datapath, ICONS,
+            style.GRID_CELL_SIZE, self._icon_pixbuf)
+
         self._record_pixbufs = []
         for icon in ['media-audio', 'media-audio-recording']:
-            self._record_pixbufs.append(
-                GdkPixbuf.Pixbuf.new_from_file_at_size(
-                    os.path.join(self._root, 'icons', icon + '.svg'),
-                    style.GRID_CELL_SIZE, style.GRID_CELL_SIZE))
+            self._record_pixbufs.append(self._atlas.get(icon))
 
         self._play_pixbufs = []
         for icon in ['play-inactive', 'play']:
-            self._play_pixbufs.append(
-                GdkPixbuf.Pixbuf.new_from_file_at_size(
-                    os.path.join(self._root, 'icons', icon + '.svg'),
-                    style.GRID_CELL_SIZE, style.GRID_CELL_SIZE))
+            self._play_pixbufs.append(self._atlas.get(icon))
 
         self._speak_pixbufs = []
         for icon in ['speak-inactive', 'speak']:
-            self._speak_pixbufs.append(
-                GdkPixbuf.Pixbuf.new_from_file_at_size(
-                    os.path.join(self._root, 'icons', icon + '.svg'),
-                    style.GRID_CELL_SIZE, style.GRID_CELL_SIZE))
+            self._speak_pixbufs.append(self._atlas.get(icon))
 
         left = style.GRID_CELL_SIZE
         right = Gdk.Screen.width() - 2 * style.GRID_CELL_SIZE
@@ -226,10 +227,7 @@ class Game():
         self._next_prev_pixbufs = []
         for icon in ['go-previous', 'go-next', 'go-previous-inactive',
                      'go-next-inactive']:
-            self._next_prev_pixbufs.append(
-                GdkPixbuf.Pixbuf.new_from_file_at_size(
-                    os.path.join(self._root, 'icons', icon + '.svg'),
-                    style.GRID_CELL_SIZE, style.GRID_CELL_SIZE))
+            self._next_prev_pixbufs.append(self._atlas.get(icon))
 
         self._prev = Sprite(
             self._sprites, left, y3, self._next_prev_pixbufs[PREV_INACTIVE])
@@ -245,6 +243,21 @@ class Game():
         if self._mode == 'array':
             self._next.hide()
 
+    def _icon_pixbuf(self, path, size):
+        ''' Render an icon from its compiled template '''
+        return svg_str_to_pixbuf(templates.load(path).render(),
+                                 w=size, h=size)
+
+    def enable_render_stats(self):
+        ''' Start measuring how the canvas is drawn '''
+        self._sprites.enable_stats()
+
+    def render_stats(self):
+        ''' Return a text report of the drawing measurements, or None '''
+        if self._sprites.stats is None:
+            return None
+        return self._sprites.stats.dump()
+
     def configure(self, move=True):
         self._width = Gdk.Screen.width()
         self._height = Gdk.Screen.height() - style.GRID_CELL_SIZE
@@ -296,12 +309,9 @@ class Game():
                         y * (self._dot_size + self._space) + yoffset))
                 self._Dots[x + y * 3].move((X, Y))
 
-        # switch orientation the bg sprite
-        if Gdk.Screen.width() > Gdk.Screen.height():
-            self._bg.set_image(self._bg_pixbufs[0])
-        else:
-            self._bg.set_image(self._bg_pixbufs[1])
-        self._bg.set_layer(-2)
+        # the background follows the orientation
+        self._sprites.invalidate_retained()
+        self._canvas.queue_draw()
 
     def set_speak_icon_state(self, state):
         if state:
@@ -335,9 +345,9 @@ class Game():
 
     def stop(self):
         self.playing = False
-        if self._parent.audio_process is not None:
-            self._parent.audio_process.terminate()
-            self._parent.audio_process = None
+        self._sound_id += 1
+        aplay.stop()
+        speech.cancel()
         if self._timeout_id is not None:
             GObject.source_remove(self._timeout_id)
             self._timeout_id = None
@@ -351,54 +361,54 @@ class Game():
             return
 
         if next:
-            self._Dots[self.current_image].hide()
-            self.current_image += 1
-            self._Dots[self.current_image].set_layer(100)
-            if self.current_image == 8:
-                self._next.set_image(
-                    self._next_prev_pixbufs[NEXT_INACTIVE])
-                self._next.set_layer(1)
-            self._prev.set_image(self._next_prev_pixbufs[PREV])
-            self._prev.set_layer(1)
+            with self._sprites.batch():
+                self._turn_page(1, crossfade=True)
+                if self.current_image == 8:
+                    self._next.set_image(
+                        self._next_prev_pixbufs[NEXT_INACTIVE])
+                    self._next.set_layer(1)
+                self._prev.set_image(self._next_prev_pixbufs[PREV])
+                self._prev.set_layer(1)
         self._parent.check_audio_status()
         self._parent.check_text_status()
         GObject.idle_add(self._play_sound)
 
-    def _poll_audio(self):
-        if self._parent.audio_process is None:  # Already stopped?
-            return
-
-        if self._parent.audio_process.poll() is None:
-            GObject.timeout_add(200, self._poll_audio)
-        else:
-            self._parent.audio_process = None
-            self._next_image()
-
     def _play_sound(self):
         self._start_time = time.time()
+        self._sound_id += 1
+        sound_id = self._sound_id
+
+        def finished_cb():
+            if sound_id == self._sound_id:
+                self._next_image()
 
         # Either play back a recording or speak the text
         if self._play.type == 'play':
-            self._parent.playback_recording_cb()
-            self._poll_audio()
+            self._parent.playback_recording_cb(finished_cb=finished_cb)
         elif self._speak.type == 'speak':
             bounds = self._parent.text_buffer.get_bounds()
             text = self._parent.text_buffer.get_text(
                 bounds[0], bounds[1], True)
-            speak(text)
+            speak(text, finished_cb)
+        else:
             self._next_image()
+        if self.playing and self.current_image < 8:
+            self._parent.preroll_recording(self.current_image + 1)
+        return False
+
+    def prepare_speech(self, text):
+        ''' Synthesize edited page text so it is ready to be spoken '''
+        self._speech_cache.synthesize_later(text, get_voice())
 
     def _next_image(self):
-        accumulated_time = int(time.time() - self._start_time)
-        if accumulated_time < 5:
-            pause = 5 - accumulated_time
-        else:
-            pause = 1
-        if self.playing and self.current_image < 8:
-            self._timeout_id = GObject.timeout_add(pause * 1000,
-                                                   self._autonext)
-        else:
+        ''' The sound for this page is over, so turn the page once it has
+        been shown for min_dwell ms, leaving at least page_gap ms '''
+        if not self.playing or self.current_image >= 8:
             self.stop()
+            return
+        shown = int((time.time() - self._start_time) * 1000)
+        pause = max(self.min_dwell - shown, self.page_gap)
+        self._timeout_id = GObject.timeout_add(pause, self._autonext)
 
     def __event_cb(self, win, event):
         ''' The mouse button was pressed. Is it on a sprite? or
@@ -421,12 +431,12 @@ class Game():
             elif event.type in (Gdk.EventType.TOUCH_END,
                                 Gdk.EventType.BUTTON_RELEASE):
 
-                if self._parent.audio_process is not None:
-                    self._parent.audio_process.terminate()
-                    self._parent.audio_process = None
+                if aplay.is_playing():
+                    aplay.stop()
                     terminated_audio = True
                 else:
                     terminated_audio = False
+                speech.cancel()  # the page may be about to change
 
                 if self.playing:
                     self.stop()
@@ -446,48 +456,47 @@ class Game():
         if event.type in (Gdk.EventType.TOUCH_END,
                           Gdk.EventType.BUTTON_RELEASE):
             spr = self._sprites.find_sprite((x, y))
-            if left or right or spr is not None:
-                if spr.type in ['record', 'play', 'play-inactive', 'speak',
-                                'speak-inactive']:
-                    if spr.type == 'record':
-                        self._parent.record_cb()
-                    elif spr.type == 'play' and not terminated_audio:
-                        self._parent.playback_recording_cb()
-                    elif spr.type == 'speak':
-                        bounds = self._parent.text_buffer.get_bounds()
-                        text = self._parent.text_buffer.get_text(
-                            bounds[0], bounds[1], True)
-                        speak(text)
-                    return
-                elif self._mode == 'array':
-                    return
-
-                self._parent.speak_text_cb()
-
-                if self._parent.recording:
+            if spr is None:  # the background is not a sprite
+                spr_type = 'background'
+            else:
+                spr_type = spr.type
+            if spr_type in ['record', 'play', 'play-inactive', 'speak',
+                            'speak-inactive']:
+                if spr_type == 'record':
                     self._parent.record_cb()
-
-                if (left or spr.type == 'prev') and self.current_image > 0:
-                    self._Dots[self.current_image].hide()
-                    self.current_image -= 1
-                    self._Dots[self.current_image].set_layer(100)
+                elif spr_type == 'play' and not terminated_audio:
+                    self._parent.playback_recording_cb()
+                elif spr_type == 'speak':
+                    bounds = self._parent.text_buffer.get_bounds()
+                    text = self._parent.text_buffer.get_text(
+                        bounds[0], bounds[1], True)
+                    speak(text)
+                return
+            elif self._mode == 'array':
+                return
+
+            self._parent.speak_text_cb()
+
+            if self._parent.recording:
+                self._parent.record_cb()
+
+            with self._sprites.batch():
+                if (left or spr_type == 'prev') and self.current_image > 0:
+                    self._turn_page(-1)
                     if self.current_image == 0:
                         self._prev.set_image(
                             self._next_prev_pixbufs[PREV_INACTIVE])
                     self._next.set_image(self._next_prev_pixbufs[NEXT])
-                elif (right or spr.type == 'next') and self.current_image < 8:
-                    self._Dots[self.current_image].hide()
-                    self.current_image += 1
-                    self._Dots[self.current_image].set_layer(100)
+                elif (right or spr_type == 'next') and \
+                        self.current_image < 8:
+                    self._turn_page(1)
                     if self.current_image == 8:
                         self._next.set_image(
                             self._next_prev_pixbufs[NEXT_INACTIVE])
                     self._prev.set_image(self._next_prev_pixbufs[PREV])
-                elif spr.type not in ['prev', 'background'] and \
+                elif spr_type not in ['prev', 'background'] and \
                         self.current_image < 8:
-                    self._Dots[self.current_image].hide()
-                    self.current_image += 1
-                    self._Dots[self.current_image].set_layer(100)
+                    self._turn_page(1)
                     if self.current_image == 8:
                         self._next.set_image(
                             self._next_prev_pixbufs[NEXT_INACTIVE])
@@ -498,74 +507,100 @@ class Game():
                 self._next.set_layer(1)
         return False
 
+    def _turn_page(self, step, crossfade=False):
+        ''' Move step pages along, sliding (or fading) to the new one '''
+        # Settle any transition still running before restacking the pages
+        self._sprites.finish_tweens()
+        old = self._Dots[self.current_image]
+        self.current_image += step
+        new = self._Dots[self.current_image]
+        new.set_layer(100)
+        self._update_window(step)
+        if crossfade:
+            self._sprites.crossfade(old, new)
+        else:
+            self._sprites.slide(old, new, step)
+
     def get_mode(self):
         return self._mode
 
     def set_mode(self, mode):
-        self.current_image = 0
-        self._prev.set_image(self._next_prev_pixbufs[PREV_INACTIVE])
-        self._next.set_image(self._next_prev_pixbufs[NEXT])
-        if mode == 'array':
-            self._mode = 'array'
-            self._prev.hide()
-            self._next.hide()
-        else:
-            self._mode = 'linear'
-            self._prev.set_layer(1)
-            self._next.set_layer(1)
-
-        for i in range(9):
-            if self._mode == 'array':
-                self._dots[i].set_layer(100)
-                self._Dots[i].hide()
+        self._sprites.finish_tweens()
+        with self._sprites.batch():
+            self.current_image = 0
+            self._prev.set_image(self._next_prev_pixbufs[PREV_INACTIVE])
+            self._next.set_image(self._next_prev_pixbufs[NEXT])
+            if mode == 'array':
+                self._mode = 'array'
+                self._prev.hide()
+                self._next.hide()
             else:
-                self._dots[i].hide()
-                if self.current_image == i:
-                    self._Dots[i].set_layer(100)
-                else:
+                self._mode = 'linear'
+                self._prev.set_layer(1)
+                self._next.set_layer(1)
+                # Make the narration of every page ready ahead of time
+                self._speech_cache.presynthesize(self._parent.page_texts(),
+                                                 get_voice())
+
+            for i in range(9):
+                if self._mode == 'array':
+                    self._dots[i].set_layer(100)
                     self._Dots[i].hide()
+                else:
+                    self._dots[i].hide()
+                    if self.current_image == i:
+                        self._Dots[i].set_layer(100)
+                    else:
+                        self._Dots[i].hide()
+            self._update_window()
 
     def _all_clear(self):
         ''' Things to reinitialize when starting up a new game. '''
         if self._timeout_id is not None:
             GObject.source_remove(self._timeout_id)
+            self._timeout_id = None
+        self._load_generation += 1  # drop any pictures still loading
+        self._loaded = set()
+        self._materialized = set()
 
-        self.set_mode(self._mode)
+        with self._sprites.batch():
+            self.set_mode(self._mode)
 
-        if self._mode == 'array':
-            for dot in self._dots:
-                if dot.type != -1:
-                    dot.type = -1
-                    dot.set_shape(self._new_dot_surface(
-                        self._colors[abs(dot.type)]))
-                    dot.set_label('?')
-        else:
-            for dot in self._Dots:
-                if dot.type != -1:
-                    dot.type = -1
-                    dot.set_shape(self._new_dot_surface(
-                        self._colors[abs(dot.type)],
-                        large=True))
-                    dot.set_label('?')
-        self._dance_counter = 0
-        self._dance_step()
-
-    def _dance_step(self):
+            if self._mode == 'array':
+                for dot in self._dots:
+                    if dot.type != -1:
+                        dot.type = -1
+                        dot.set_shape(self._new_dot_surface(
+                            self._colors[abs(dot.type)]))
+                        dot.set_label('?')
+            else:
+                for dot in self._Dots:
+                    if dot.type != -1:
+                        dot.type = -1
+                        dot.set_shape(self._new_dot_surface(
+                            self._colors[abs(dot.type)],
+                            large=True))
+                        dot.set_label('?')
+        self._dance.start()
+
+    def _dance_step(self, step):
         ''' Short animation before loading new game '''
-        if self._mode == 'array':
-            for dot in self._dots:
-                dot.set_shape(self._new_dot_surface(
-                    self._colors[int(uniform(0, 3))]))
-        else:
-            self._Dots[0].set_shape(self._new_dot_surface(
-                self._colors[int(uniform(0, 3))],
-                large=True))
+        with self._sprites.batch():
+            if self._mode == 'array':
+                frames = self._get_dance_frames(False)
+                for dot in self._dots:
+                    dot.set_shape(frames[int(uniform(0, 3))])
+            else:
+                frames = self._get_dance_frames(True)
+                self._Dots[0].set_shape(frames[int(uniform(0, 3))])
 
-        self._dance_counter += 1
-        if self._dance_counter < 10:
-            self._timeout_id = GObject.timeout_add(500, self._dance_step)
-        else:
-            self._new_images()
+    def _get_dance_frames(self, large):
+        ''' The colored dots are rendered the first time they are used '''
+        if large not in self._dance_frames:
+            self._dance_frames[large] = [
+                self._new_dot_surface(color, large=large)
+                for color in self._colors]
+        return self._dance_frames[large]
 
     def new_game(self):
         ''' Start a new game. '''
@@ -574,30 +609,15 @@ class Game():
     def _new_images(self):
         ''' Select pictures at random '''
         used_images = [0] * self.number_of_images
+        dot_list = []
         for i in range(9):
             random_selection = int(uniform(0, self.number_of_images))
             while used_images[random_selection] != 0:
                 random_selection = int(uniform(0, self.number_of_images))
             used_images[random_selection] = 1
-            self._dots[i].set_label('')
-            self._dots[i].type = random_selection
-            self._dots[i].set_shape(self._new_dot_surface(
-                image=self._dots[i].type))
-
-            self._Dots[i].set_label('')
-            self._Dots[i].type = self._dots[i].type
-            self._Dots[i].set_shape(self._new_dot_surface(
-                image=self._Dots[i].type, large=True))
+            dot_list.append(random_selection)
 
-            if self._mode == 'array':
-                self._dots[i].set_layer(100)
-                self._Dots[i].hide()
-            else:
-                if self.current_image == i:
-                    self._Dots[i].set_layer(100)
-                else:
-                    self._Dots[i].hide()
-                self._dots[i].hide()
+        self._load_images(dot_list)
 
         if self.we_are_sharing:
             self._parent.send_new_images()
@@ -605,28 +625,152 @@ class Game():
     def restore_game(self, dot_list):
         ''' Restore a game from the Journal or share '''
 
-        self.set_mode(self._mode)
+        self._dance.cancel()
+        # The pictures of the previous game are no use to set_mode
+        self._loaded = set()
+        self._materialized = set()
+        with self._sprites.batch():
+            self.set_mode(self._mode)
+            self._load_images(dot_list)
+
+    def _load_images(self, dot_list):
+        ''' Put the chosen pictures on the dots, either right away or,
+        in asynchronous mode, as they are rendered in the background '''
+        self._load_generation += 1
+        self._loaded = set()
+        self._materialized = set()
+
+        with self._sprites.batch():
+            for i, dot in enumerate(dot_list):
+                self._dots[i].type = dot
+                self._Dots[i].type = dot
+                if self.async_load:
+                    self._dots[i].set_shape(
+                        self._new_dot_surface(color=self._colors[0]))
+                    self._dots[i].set_label('?')
+                    self._Dots[i].set_shape(self._new_dot_surface(
+                        color=self._colors[0], large=True))
+                    self._Dots[i].set_label('?')
+                else:
+                    self._apply_images(self._load_generation, i,
+                                       *self._new_image_surfaces(dot))
+
+                if self._mode == 'array':
+                    self._dots[i].set_layer(100)
+                    self._Dots[i].hide()
+                else:
+                    if self.current_image == i:
+                        self._Dots[i].set_layer(100)
+                    else:
+                        self._Dots[i].hide()
+                    self._dots[i].hide()
+
+        if not self.async_load:
+            _logger.debug('surface cache: %s' % surface_cache.stats())
+            return
+
+        # The page on show comes first.
+        order = list(range(len(dot_list)))
+        if self._mode == 'linear' and self.current_image in order:
+            order.remove(self.current_image)
+            order.insert(0, self.current_image)
+        thread = threading.Thread(
+            target=self._render_images,
+            args=(self._load_generation, order, list(dot_list)))
+        thread.daemon = True
+        thread.start()
+
+    def _render_images(self, generation, order, dot_list):
+        ''' Worker thread: render the pictures and hand them to the main
+        loop one at a time '''
+        for i in order:
+            if generation != self._load_generation:
+                return  # superseded by a newer game
+            try:
+                small, large = self._new_image_surfaces(dot_list[i])
+            except Exception as e:
+                _logger.error('render image %d: %s' % (dot_list[i], e))
+                continue
+            GObject.idle_add(self._apply_images, generation, i, small, large)
+        GObject.idle_add(self._images_loaded, generation)
+
+    def _apply_images(self, generation, i, small, large):
+        ''' Swap rendered pictures in for the placeholders '''
+        if generation != self._load_generation:
+            return False
+        self._dots[i].set_shape(small)
+        self._dots[i].set_label('')
+        self._Dots[i].set_label('')
+        self._loaded.add(i)
+        if i in self._page_window():
+            self._Dots[i].set_shape(large)
+            self._materialized.add(i)
+        else:
+            self._release_page(i)
+        return False
 
-        for i, dot in enumerate(dot_list):
-            self._dots[i].type = dot
-            self._dots[i].set_shape(self._new_dot_surface(
-                image=self._dots[i].type))
-            self._dots[i].set_label('')
+    def _images_loaded(self, generation):
+        if generation == self._load_generation:
+            _logger.debug('surface cache: %s' % surface_cache.stats())
+        return False
 
-            self._Dots[i].type = dot
-            self._Dots[i].set_shape(self._new_dot_surface(
-                image=self._Dots[i].type, large=True))
-            self._Dots[i].set_label('')
+    def _page_window(self):
+        ''' The pages that should hold their large surfaces '''
+        if self._mode != 'linear':
+            return set()
+        return set(range(max(0, self.current_image - PAGE_WINDOW),
+                         min(8, self.current_image + PAGE_WINDOW) + 1))
+
+    def _update_window(self, direction=0):
+        ''' Release pages that have left the window around the current
+        page and prefetch the rest, in the direction of travel first. '''
+        window = self._page_window()
+        for i in list(self._materialized - window):
+            self._release_page(i)
+
+        if self._prefetch_id is not None:
+            GObject.source_remove(self._prefetch_id)
+            self._prefetch_id = None
+        if self.current_image in window:
+            self._materialize_page(self.current_image)
+        pending = sorted(window - self._materialized,
+                         key=lambda i: (direction * (self.current_image - i),
+                                        abs(i - self.current_image)))
+        if pending:
+            self._prefetch_id = GObject.idle_add(self._prefetch, pending)
+
+    def _prefetch(self, pending):
+        ''' Materialize one page per idle call '''
+        self._materialize_page(pending.pop(0))
+        if pending:
+            return True
+        self._prefetch_id = None
+        return False
 
-            if self._mode == 'array':
-                self._dots[i].set_layer(100)
-                self._Dots[i].hide()
-            else:
-                if self.current_image == i:
-                    self._Dots[i].set_layer(100)
-                else:
-                    self._Dots[i].hide()
-                self._dots[i].hide()
+    def _materialize_page(self, i):
+        if i in self._materialized or i not in self._loaded:
+            return
+        self._Dots[i].set_shape(self.page_surface(i))
+        self._materialized.add(i)
+
+    def _release_page(self, i):
+        ''' Let go of the large surface of a page we are not near. It can
+        be mapped back from the tile cache when it is needed again. '''
+        self._materialized.discard(i)
+        if self._Dots[i].type != -1:
+            surface_cache.discard(self._page_key(self._Dots[i].type))
+        self._Dots[i].set_image(self._released_surface)
+
+    def _page_key(self, image):
+        return self._tile_key(self._image_identity(image),
+                              self._image_color(image), self._dot_size * 3)
+
+    def page_surface(self, i):
+        ''' Return the large surface for page i, even if it is not
+        materialized '''
+        if i in self._materialized or i not in self._loaded:
+            return self._Dots[i].images[0]
+        return self._new_dot_surface(image=self._Dots[i].type, large=True)
 
     def save_game(self):
         ''' Return dot list for saving to Journal or
@@ -650,6 +794,29 @@ class Game():
     def __draw_cb(self, canvas, cr):
         self._sprites.redraw_sprites(cr=cr)
 
+    def _draw_background(self, cr):
+        ''' Paint the white background, leaving a hole for the text
+        entry. Only the area inside the clip is filled. '''
+        width = Gdk.Screen.width()
+        height = Gdk.Screen.height()
+        if self._parent.tablet_mode:  # text on top
+            y1 = style.DEFAULT_SPACING
+            y2 = style.GRID_CELL_SIZE * 3 + style.DEFAULT_SPACING
+        else:  # text on bottom
+            y1 = height - style.GRID_CELL_SIZE * 4 - style.DEFAULT_SPACING
+            y2 = height - style.GRID_CELL_SIZE - style.DEFAULT_SPACING
+        x1 = 3 * style.GRID_CELL_SIZE
+        x2 = width - 3 * style.GRID_CELL_SIZE
+
+        left, top, right, bottom = cr.clip_extents()
+        cr.save()
+        cr.set_fill_rule(cairo.FILL_RULE_EVEN_ODD)
+        cr.rectangle(left, top, right - left, bottom - top)
+        cr.rectangle(x1, y1, x2 - x1, y2 - y1)
+        cr.set_source_rgb(1, 1, 1)
+        cr.fill()
+        cr.restore()
+
     def __expose_cb(self, win, event):
         ''' Callback to handle window expose events '''
         self.do_expose_event(event)
@@ -699,7 +866,7 @@ class Game():
             y = self._space
             x = self._space
             cr.save()
-            cr.set_source_surface(self._Dots[self.current_image].images[0],
+            cr.set_source_surface(self.page_surface(self.current_image),
                                   x, y)
             cr.rectangle(x, y, 3 * self._dot_size, 3 * self._dot_size)
             cr.fill()
@@ -714,162 +881,143 @@ class Game():
             size = self._dot_size * 3
         else:
             size = self._dot_size
-        self._svg_width = size
-        self._svg_height = size
 
         if image is None:  # color dot
-            self._stroke = color
-            self._fill = color
-            pixbuf = svg_str_to_pixbuf(
-                self._header() +
-                self._circle(size / 2., size / 2., size / 2.) +
-                self._footer())
+            identity = 'dot'
         else:
-            if USE_ART4APPS:
-                word = next(
-                    islice(self._art4apps.get_words(), image, None),
-                    None)
-                try:
-                    pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-                        self._art4apps.get_image_filename(word), size, size)
-                except Exception as e:
-                    _logger.error('new dot surface %s %s: %s' %
-                                  (image, word, e))
-                    word = 'zebra'  # default in case image is not found
-                    pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-                        self._art4apps.get_image_filename(word), size, size)
-            else:
-                # Set SVG color
-                color = COLORS[int(uniform(0, 6))]
-                fd = open(os.path.join(self._path, self._PATHS[image]), 'r')
-                svg_string = ''
-                for line in fd:
-                    svg_string += line.replace('#000000', color)
-                fd.close()
-                pixbuf = svg_str_to_pixbuf(svg_string, w=size, h=size)
-
-        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
-                                     self._svg_width, self._svg_height)
-        context = cairo.Context(surface)
-        Gdk.cairo_set_source_pixbuf(context, pixbuf, 0, 0)
-        context.rectangle(0, 0, self._svg_width, self._svg_height)
-        context.fill()
+            # Set SVG color
+            color = self._image_color(image)
+            identity = self._image_identity(image)
+
+        key = self._tile_key(identity, color, size)
+        surface = self._cached_surface(key)
+        if surface is not None:
+            return surface
+
+        # This runs on the loading thread too, so GDK must not be used.
+        if image is None:
+            surface = render_svg(gendot(size, color), size)
+        elif USE_ART4APPS:
+            word = next(
+                islice(self._art4apps.get_words(), image, None),
+                None)
+            try:
+                surface = render_image(
+                    self._art4apps.get_image_filename(word), size)
+            except Exception as e:
+                _logger.error('new dot surface %s %s: %s' %
+                              (image, word, e))
+                word = 'zebra'  # default in case image is not found
+                surface = render_image(
+                    self._art4apps.get_image_filename(word), size)
+        else:
+            svg_string = templates.load(self._image_path(image)).render(
+                color=color)
+            surface = render_svg(svg_string, size)
+
+        self._cache_surface(key, surface)
         return surface
 
-    def _header(self):
-        return '<svg\n' + 'xmlns:svg="http://www.w3.org/2000/svg"\n' + \
-            'xmlns="http://www.w3.org/2000/svg"\n' + \
-            'xmlns:xlink="http://www.w3.org/1999/xlink"\n' + \
-            'version="1.1"\n' + 'width="' + str(self._svg_width) + '"\n' + \
-            'height="' + str(self._svg_height) + '">\n'
-
-    def _rect(self, w, h, x, y):
-        svg_string = '       <rect\n'
-        svg_string += '          width="%f"\n' % (w)
-        svg_string += '          height="%f"\n' % (h)
-        svg_string += '          rx="%f"\n' % (0)
-        svg_string += '          ry="%f"\n' % (0)
-        svg_string += '          x="%f"\n' % (x)
-        svg_string += '          y="%f"\n' % (y)
-        svg_string += 'style="fill:#000000;stroke:#000000;"/>\n'
-        return svg_string
-
-    def _circle(self, r, cx, cy):
-        return '<circle style="fill:' + str(self._fill) + ';stroke:' + \
-            str(self._stroke) + ';" r="' + str(r - 0.5) + '" cx="' + \
-            str(cx) + '" cy="' + str(cy) + '" />\n'
-
-    def _footer(self):
-        return '</svg>\n'
-
-
-def genblank(w, h, colors, stroke_width=1.0):
-    svg = SVG()
-    svg.set_colors(colors)
-    svg.set_stroke_width(stroke_width)
-    svg_string = svg.header(w, h)
-    svg_string += svg.footer()
-    return svg_string
-
-
-def genhole(w, h, x1, y1, x2, y2):
-    return \
-        '<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n' + \
-        '<svg ' + \
-        '   width="%d"' % w + \
-        '   height="%d">\n' % h + \
-        '    <path ' + \
-        '       d="m 0,0 0,%d %d,0 0,%d z m %d,%d %d,0 0,%d %d,0 z"' % \
-        (h, w, -h, x1, y1, x2 - x1, y2 - y1, x1 - x2) + \
-        '       style="fill:#FFFFFF;fill-opacity:1;' \
-        'stroke:none;stroke-width:3.5;" />\n' + \
-        '</svg>'
-
-
-class SVG:
-    ''' SVG generators '''
-
-    def __init__(self):
-        self._scale = 1
-        self._stroke_width = 1
-        self._fill = '#FFFFFF'
-        self._stroke = '#FFFFFF'
-
-    def _svg_style(self, extras=""):
-        return "%s%s%s%s%s%f%s%s%s" % ("style=\"fill:", self._fill, ";stroke:",
-                                       self._stroke, ";stroke-width:",
-                                       self._stroke_width, ";", extras,
-                                       "\" />\n")
-
-    def _svg_rect(self, w, h, rx, ry, x, y):
-        svg_string = "       <rect\n"
-        svg_string += "          width=\"%f\"\n" % (w)
-        svg_string += "          height=\"%f\"\n" % (h)
-        svg_string += "          rx=\"%f\"\n" % (rx)
-        svg_string += "          ry=\"%f\"\n" % (ry)
-        svg_string += "          x=\"%f\"\n" % (x)
-        svg_string += "          y=\"%f\"\n" % (y)
-        self.set_stroke_width(self._stroke_width)
-        svg_string += self._svg_style()
-        return svg_string
-
-    def _background(self, w=80, h=60, scale=1):
-        return self._svg_rect((w - 0.5) * scale, (h - 0.5) * scale,
-                              1, 1, 0.25, 0.25)
-
-    def header(self, w=80, h=60, scale=1, background=True):
-        svg_string = "<?xml version=\"1.0\" encoding=\"UTF-8\""
-        svg_string += " standalone=\"no\"?>\n"
-        svg_string += "<!-- Created with Emacs -->\n"
-        svg_string += "<svg\n"
-        svg_string += "   xmlns:svg=\"http://www.w3.org/2000/svg\"\n"
-        svg_string += "   xmlns=\"http://www.w3.org/2000/svg\"\n"
-        svg_string += "   version=\"1.0\"\n"
-        svg_string += "%s%f%s" % ("   width=\"", scale * w * self._scale,
-                                  "\"\n")
-        svg_string += "%s%f%s" % ("   height=\"", scale * h * self._scale,
-                                  "\">\n")
-        svg_string += "%s%f%s%f%s" % ("<g\n       transform=\"matrix(",
-                                      self._scale, ",0,0,", self._scale,
-                                      ",0,0)\">\n")
-        if background:
-            svg_string += self._background(w, h, scale)
-        return svg_string
-
-    def footer(self):
-        svg_string = "</g>\n"
-        svg_string += "</svg>\n"
-        return svg_string
-
-    def set_scale(self, scale=1.0):
-        self._scale = scale
-
-    def set_colors(self, colors):
-        self._stroke = colors[0]
-        self._fill = colors[1]
-
-    def set_stroke_width(self, stroke_width=1.0):
-        self._stroke_width = stroke_width
+    def _new_image_surfaces(self, image):
+        ''' Render an image once, at page size, and derive the grid tile
+        from it. Returns (small, large) surfaces. '''
+        large = self._new_dot_surface(image=image, large=True)
+
+        size = self._dot_size
+        key = self._tile_key('small:%s:%d' % (self._image_identity(image),
+                                              large.get_width()),
+                             self._image_color(image), size)
+        small = self._cached_surface(key)
+        if small is None:
+            small = scale_surface(large, size, size)
+            self._cache_surface(key, small)
+        return small, large
+
+    def _image_color(self, image):
+        ''' Each image keeps the same color on the grid and the page '''
+        if USE_ART4APPS:
+            return None
+        return COLORS[image % len(COLORS)]
+
+    def _tile_key(self, identity, color, size):
+        return tile_key(identity, color, size, self._scale_factor)
+
+    def _cached_surface(self, key):
+        ''' Look for a surface in memory, then on disk '''
+        surface = surface_cache.get(key)
+        if surface is None:
+            surface = self._tile_cache.get(key)
+            if surface is not None:
+                surface_cache.put(key, surface)
+        return surface
+
+    def _cache_surface(self, key, surface):
+        self._tile_cache.put(key, surface)
+        surface_cache.put(key, surface)
+
+    def _image_path(self, image):
+        return os.path.join(self._path, self._PATHS[image])
+
+    def _image_identity(self, image):
+        ''' Name an image file by path, size and modification time '''
+        if USE_ART4APPS:
+            return 'art4apps:%d' % image
+        path = self._image_path(image)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return path
+        return '%s:%d:%d' % (path, stat.st_size, int(stat.st_mtime))
+
+
+DOT_SVG = \
+    '<svg\n' + 'xmlns:svg="http://www.w3.org/2000/svg"\n' + \
+    'xmlns="http://www.w3.org/2000/svg"\n' + \
+    'xmlns:xlink="http://www.w3.org/1999/xlink"\n' + \
+    'version="1.1"\n' + 'width="${size}"\n' + 'height="${size}">\n' + \
+    '<circle style="fill:${color};stroke:${color};" r="${r}"' + \
+    ' cx="${c}" cy="${c}" />\n' + \
+    '</svg>\n'
+
+
+def gendot(size, color):
+    return templates.compile('dot', DOT_SVG).render(
+        size=size, color=color, r=size / 2. - 0.5, c=size / 2.)
+
+
+def scale_surface(surface, w, h):
+    ''' Return a high-quality scaled copy of an image surface '''
+    scaled = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+    context = cairo.Context(scaled)
+    context.scale(w / surface.get_width(), h / surface.get_height())
+    context.set_source_surface(surface, 0, 0)
+    context.get_source().set_filter(cairo.FILTER_BEST)
+    context.paint()
+    return scaled
+
+
+def render_svg(svg_string, size):
+    ''' Draw an SVG stretched over a size x size surface '''
+    handle = Rsvg.Handle.new_from_data(svg_string.encode('utf-8'))
+    dimensions = handle.get_dimensions()
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
+    context = cairo.Context(surface)
+    context.scale(size / dimensions.width, size / dimensions.height)
+    handle.render_cairo(context)
+    return surface
+
+
+def render_image(path, size):
+    ''' Draw a PNG file scaled to fit a size x size surface '''
+    image = cairo.ImageSurface.create_from_png(path)
+    scale = min(size / image.get_width(), size / image.get_height())
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
+    context = cairo.Context(surface)
+    context.scale(scale, scale)
+    context.set_source_surface(image, 0, 0)
+    context.get_source().set_filter(cairo.FILTER_BEST)
+    context.paint()
+    return surface
 
 
 def svg_str_to_pixbuf(svg_string, w=None, h=None):
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026 Sugar Labs
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+'''
+iconatlas.py rasterizes a set of square icons into a single surface, one
+above the other, and keeps it on disk as a PNG. Each icon is handed out
+as a cairo.ImageSurface that shares the pixels of the atlas.
+'''
+
+import os
+import hashlib
+import tempfile
+
+from gi.repository import Gdk
+import cairo
+
+import logging
+_logger = logging.getLogger('story-activity')
+
+
+class IconAtlas:
+    ''' A column of icons rendered at one size '''
+
+    def __init__(self, icon_dir, cache_dir, names, size, render):
+        ''' render(path, size) returns a pixbuf for the icon at path '''
+        self._names = list(names)
+        self._size = size
+        self._icons = {}
+        sources = [os.path.join(icon_dir, name + '.svg')
+                   for name in self._names]
+        digest = hashlib.sha1('|'.join(self._names).encode('utf-8'))
+        path = os.path.join(cache_dir, 'icons-%d-%s.png' %
+                            (size, digest.hexdigest()[:8]))
+
+        self._surface = self._load(path, sources)
+        if self._surface is None:
+            self._surface = self._build(sources, render)
+            self._save(path)
+
+    def _load(self, path, sources):
+        ''' Read the cached atlas, if it is still good '''
+        try:
+            mtime = os.path.getmtime(path)
+            if any(os.path.getmtime(source) > mtime for source in sources):
+                return None
+            surface = cairo.ImageSurface.create_from_png(path)
+        except (OSError, cairo.Error):
+            return None
+        if surface.get_format() != cairo.FORMAT_ARGB32 or \
+                surface.get_width() != self._size or \
+                surface.get_height() != self._size * len(self._names):
+            return None
+        return surface
+
+    def _save(self, path):
+        ''' Write the atlas beside path and then move it into place, as
+        other instances may be reading the same file '''
+        try:
+            fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+        except OSError as e:
+            _logger.error('icon atlas %s: %s' % (path, e))
+            return
+        try:
+            with os.fdopen(fd, 'wb') as png:
+                self._surface.write_to_png(png)
+            os.replace(temporary, path)
+        except (OSError, cairo.Error) as e:
+            _logger.error('icon atlas %s: %s' % (path, e))
+            os.remove(temporary)
+
+    def _build(self, sources, render):
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self._size,
+                                     self._size * len(self._names))
+        context = cairo.Context(surface)
+        for i, source in enumerate(sources):
+            Gdk.cairo_set_source_pixbuf(context, render(source, self._size),
+                                        0, i * self._size)
+            context.rectangle(0, i * self._size, self._size, self._size)
+            context.fill()
+        surface.flush()
+        return surface
+
+    def get(self, name):
+        ''' Return the icon as a surface that shares the atlas pixels '''
+        if name not in self._icons:
+            stride = self._surface.get_stride()
+            offset = self._names.index(name) * self._size * stride
+            data = self._surface.get_data()[offset:
+                                            offset + self._size * stride]
+            self._icons[name] = cairo.ImageSurface.create_for_data(
+                data, cairo.FORMAT_ARGB32, self._size, self._size, stride)
+        return self._icons[name]
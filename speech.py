@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026 Sugar Labs
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+'''
+speech.py is a long-lived speech service. Text is synthesized with
+espeak on a worker thread (through a SpeechCache, so repeated text is
+not synthesized again) and played back through aplay as soon as espeak
+has written it; the main loop is never blocked. The voice follows the
+language, and the rate and pitch the Sugar speech settings. When espeak
+cannot be used, sugar's SpeechManager speaks instead.
+
+Each utterance can report when it starts and when it is finished, and
+estimate its progress through the text. The estimate spreads the words
+over the length of the audio in proportion to their position in the
+text; neither espeak nor SpeechManager reports where words really fall,
+so it suits a rough reading guide, not exact word highlighting.
+
+Example usage:
+        from speech import speech
+
+        speech.set_cache(SpeechCache(path))
+        speech.say(text, voice, progress_cb=self._guide,
+                   finished_cb=self._next_page)
+        ...
+        speech.cancel()
+'''
+
+import re
+import time
+import threading
+from collections import deque
+
+from gi.repository import GObject
+
+from aplay import aplay
+from speechcache import speech_settings
+
+import logging
+_logger = logging.getLogger('story-activity')
+
+_WORD = re.compile(r'\S+')
+
+
+class _Utterance:
+    __slots__ = ('text', 'voice', 'rate', 'pitch', 'started_cb',
+                 'progress_cb', 'finished_cb', 'path', 'cancelled')
+
+    def __init__(self, text, voice, started_cb, progress_cb, finished_cb):
+        self.text = text
+        self.voice = voice
+        self.rate, self.pitch = speech_settings()
+        self.started_cb = started_cb
+        self.progress_cb = progress_cb
+        self.finished_cb = finished_cb
+        self.path = None
+        self.cancelled = False
+
+
+class SpeechService:
+    ''' Speaks text one utterance at a time '''
+
+    def __init__(self):
+        self._cache = None
+        self._jobs = deque()  # utterances waiting to be synthesized
+        self._condition = threading.Condition()
+        self._thread = None
+        self._ready = deque()  # synthesized utterances waiting their turn
+        self._current = None  # the utterance being spoken
+        self._words = []  # estimated (seconds, start, end) still to come
+        self._start_time = 0
+        self._word_id = None
+        self._manager = None
+        aplay.connect('started', self._aplay_started_cb)
+
+    def set_cache(self, cache):
+        ''' Use a SpeechCache to synthesize and keep the audio '''
+        self._cache = cache
+
+    def say(self, text, voice=None, started_cb=None, progress_cb=None,
+            finished_cb=None, interrupt=True):
+        ''' Speak text. started_cb() is called when the audio starts,
+        progress_cb(start, end) when the speech is estimated to have
+        reached the word text[start:end] and finished_cb() at the end, but
+        none are called once cancelled. By
+        default anything already being said is cancelled; otherwise text
+        is said after it. '''
+        if interrupt:
+            self.cancel()
+        job = _Utterance(str(text), voice, started_cb, progress_cb,
+                         finished_cb)
+        with self._condition:
+            self._jobs.append(job)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+        return job
+
+    def cancel(self):
+        ''' Stop speaking and drop anything waiting to be said '''
+        with self._condition:
+            for job in self._jobs:
+                job.cancelled = True
+            self._jobs.clear()
+        for job in self._ready:
+            job.cancelled = True
+        self._ready.clear()
+        job, self._current = self._current, None
+        self._stop_words()
+        if job is None:
+            return
+        job.cancelled = True
+        if job.path is not None:
+            aplay.stop()
+        elif self._manager is not None:
+            self._manager.stop()
+
+    def is_speaking(self):
+        return self._current is not None
+
+    def _work(self):
+        ''' Worker thread: synthesize each utterance in turn '''
+        while True:
+            with self._condition:
+                while not self._jobs:
+                    self._condition.wait()
+                job = self._jobs.popleft()
+            if job.cancelled:
+                continue
+            path = None
+            try:
+                if self._cache is not None and self._cache.available:
+                    path = self._cache.synthesize(job.text, job.voice,
+                                                  job.rate, job.pitch,
+                                                  wait=False)
+            except Exception:
+                # The worker must live on, and the job must still finish
+                _logger.exception('speech: synthesizing %r failed' %
+                                  job.text)
+            GObject.idle_add(self._speak, job, path)
+
+    def _speak(self, job, path):
+        if job.cancelled:
+            return False
+        job.path = path
+        self._ready.append(job)
+        self._next()
+        return False
+
+    def _next(self):
+        ''' Start the next utterance, unless one is being spoken '''
+        while self._ready and self._current is None:
+            job = self._ready.popleft()
+            self._current = job
+            if job.path is not None:
+                aplay.play(job.path, lambda job=job: self._finish(job))
+            else:
+                self._say_with_manager(job)
+
+    def _say_with_manager(self, job):
+        try:
+            from sugar3.speech import SpeechManager
+        except ImportError:
+            _logger.error('speech: no speech engine is available')
+            self._finish(job)
+            return
+        if self._manager is None:
+            self._manager = SpeechManager()
+            self._manager.connect('stop', self._manager_stop_cb)
+        # Saying something new may stop whatever was being said.
+        self._current = None
+        self._manager.say_text(job.text)
+        self._current = job
+        if not self._manager.enabled():
+            self._finish(job)
+            return
+        self._begin(job, None)
+
+    def _manager_stop_cb(self, manager):
+        if self._current is not None and self._current.path is None:
+            self._finish(self._current)
+
+    def _aplay_started_cb(self, player, name):
+        job = self._current
+        if job is not None and job.path == name:
+            self._begin(job, player.duration())
+
+    def _begin(self, job, duration):
+        ''' The audio has started; report it and estimate the word times '''
+        if job.started_cb is not None:
+            job.started_cb()
+        if job.progress_cb is None:
+            return
+        words = [(match.start(), match.end())
+                 for match in _WORD.finditer(job.text)]
+        if not words:
+            return
+        if not duration:  # guess from the speaking rate
+            duration = len(words) * 60. / job.rate
+        self._words = [(duration * start / len(job.text), start, end)
+                       for start, end in words]
+        self._start_time = time.time()
+        self._next_word()
+
+    def _next_word(self):
+        self._word_id = None
+        job = self._current
+        while self._words and job is not None:
+            seconds, start, end = self._words[0]
+            wait = seconds - (time.time() - self._start_time)
+            if wait > 0:
+                self._word_id = GObject.timeout_add(int(wait * 1000),
+                                                    self._next_word)
+                break
+            self._words.pop(0)
+            job.progress_cb(start, end)
+        return False
+
+    def _stop_words(self):
+        self._words = []
+        if self._word_id is not None:
+            GObject.source_remove(self._word_id)
+            self._word_id = None
+
+    def _finish(self, job):
+        if job is not self._current:
+            return
+        self._current = None
+        self._stop_words()
+        if job.finished_cb is not None:
+            job.finished_cb()
+        self._next()
+
+
+speech = SpeechService()
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026 Sugar Labs
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+'''
+speechcache.py keeps spoken page text as Ogg Vorbis files in the activity
+instance directory, so that text which has been synthesized once can be
+played back through aplay rather than synthesized again. Speech that is
+wanted straight away can be played from the WAV espeak writes while it
+is being compressed.
+
+Files are named after the SHA-1 of the text, voice, rate and pitch, so a
+change to any of them makes a new entry. The rate and pitch are those the
+user chose in the Sugar speech settings.
+
+Example usage:
+        self._speech_cache = SpeechCache(os.path.join(datapath, 'speech'))
+
+        rate, pitch = speech_settings()
+        path = self._speech_cache.lookup(text, voice, rate, pitch)
+        if path is not None:
+            aplay.play(path)
+        self._speech_cache.presynthesize(texts, voice)
+        self._speech_cache.synthesize_later(edited_text, voice)
+'''
+
+import os
+import hashlib
+import subprocess
+import tempfile
+import threading
+import time
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gio, GLib, Gst
+
+import logging
+_logger = logging.getLogger('story-activity')
+
+Gst.init(None)
+
+RATE = 175  # espeak words per minute
+PITCH = 50  # espeak pitch, 0 to 99
+MIN_RATE = 80  # the slowest and fastest espeak will speak
+MAX_RATE = 450
+SETTINGS = 'org.sugarlabs.speech'  # rate and pitch, each -100 to 100
+MAX_ENTRIES = 100  # oldest files are removed beyond this
+ENCODE_TIMEOUT = 60  # seconds
+WAV_KEEP = 60  # seconds a WAV outlives its Ogg file, in case it is playing
+
+
+def speech_settings():
+    ''' The espeak rate and pitch matching the Sugar speech settings, or
+    the espeak defaults where there are none '''
+    source = Gio.SettingsSchemaSource.get_default()
+    if source is None or source.lookup(SETTINGS, True) is None:
+        return RATE, PITCH
+    settings = Gio.Settings.new(SETTINGS)
+    rate = max(-100, min(100, settings.get_int('rate')))
+    pitch = max(-100, min(100, settings.get_int('pitch')))
+    # 0 is the usual speed, so it maps to the espeak default
+    if rate < 0:
+        rate = RATE + (RATE - MIN_RATE) * rate // 100
+    else:
+        rate = RATE + (MAX_RATE - RATE) * rate // 100
+    return rate, min(99, (pitch + 100) // 2)
+
+
+class SpeechCache:
+    ''' Synthesized speech stored as compressed files '''
+
+    def __init__(self, path):
+        self._path = path
+        self._generation = 0
+        self.available = True  # False once espeak turns out to be missing
+        try:
+            os.makedirs(self._path, exist_ok=True)
+        except OSError as e:
+            _logger.error('speech cache %s: %s' % (self._path, e))
+            self.available = False
+
+    def _file(self, text, voice, rate, pitch):
+        key = '%s|%s|%d|%d' % (text, voice, rate, pitch)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self._path, 'tts-%s.ogg' % digest)
+
+    def lookup(self, text, voice, rate, pitch):
+        ''' Return the path of the cached speech for text, or None '''
+        path = self._file(text, voice, rate, pitch)
+        # The WAV is there while the Ogg file is being made
+        for path in (path, _wav(path)):
+            try:
+                os.utime(path)  # most recently used files are kept longest
+            except OSError:
+                continue
+            return path
+        return None
+
+    def synthesize(self, text, voice, rate, pitch, wait=True):
+        ''' Synthesize text unless it is cached, and return the path of
+        the file, or None. This blocks, so it belongs on a worker
+        thread; read the rate and pitch with speech_settings() first.
+        With wait=False, the path of the WAV is returned as soon as espeak
+        has written it, and it is compressed on another thread. '''
+        path = self.lookup(text, voice, rate, pitch)
+        if path is not None or not self.available:
+            return path
+        path = self._file(text, voice, rate, pitch)
+        command = ['espeak', '-s', str(rate), '-p', str(pitch)]
+        if voice is not None:
+            command += ['-v', voice]
+        # The text goes in on stdin, never through a shell.
+        command += ['--stdin', '--stdout']
+        try:
+            wav = subprocess.run(command, input=str(text).encode('utf-8'),
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL,
+                                 check=True).stdout
+        except FileNotFoundError:
+            _logger.error('speech cache: espeak is not installed')
+            self.available = False
+            return None
+        except subprocess.CalledProcessError as e:
+            _logger.error('speech cache: %s' % e)
+            return None
+
+        wav_path = _wav(path)
+        temporary = None
+        try:
+            fd, temporary = tempfile.mkstemp(dir=self._path)
+            with os.fdopen(fd, 'wb') as wav_file:
+                wav_file.write(wav)
+            # Files only ever appear complete
+            os.rename(temporary, wav_path)
+        except OSError as e:
+            _logger.error('speech cache %s: %s' % (wav_path, e))
+            if temporary is not None and os.path.exists(temporary):
+                os.remove(temporary)
+            return None
+        if wait:
+            return self._compress(path, keep_wav=False) or wav_path
+        thread = threading.Thread(target=self._compress, args=(path, True))
+        thread.daemon = True
+        thread.start()
+        return wav_path
+
+    def _compress(self, path, keep_wav):
+        ''' Encode the WAV for path into path; returns path or None. The
+        WAV stays in the cache if it cannot be encoded. '''
+        wav_path = _wav(path)
+        try:
+            fd, ogg_path = tempfile.mkstemp(dir=self._path)
+            os.close(fd)
+        except OSError as e:
+            _logger.error('speech cache %s: %s' % (path, e))
+            return None
+        try:
+            if not _encode(wav_path, ogg_path):
+                return None
+            os.rename(ogg_path, path)
+            if not keep_wav:
+                os.remove(wav_path)
+        except OSError as e:
+            _logger.error('speech cache %s: %s' % (path, e))
+            return None
+        finally:
+            if os.path.exists(ogg_path):
+                os.remove(ogg_path)
+        self._prune()
+        return path
+
+    def presynthesize(self, texts, voice=None):
+        ''' Synthesize texts on a background thread. A later call takes
+        over from any earlier one still running. '''
+        self._generation += 1
+        if not self.available:
+            return
+        rate, pitch = speech_settings()
+        thread = threading.Thread(
+            target=self._presynthesize,
+            args=(self._generation, list(texts), voice, rate, pitch))
+        thread.daemon = True
+        thread.start()
+
+    def synthesize_later(self, text, voice=None):
+        ''' Synthesize one text on a background thread, leaving any
+        presynthesize() batch running '''
+        if not self.available:
+            return
+        rate, pitch = speech_settings()
+        thread = threading.Thread(target=self.synthesize,
+                                  args=(text, voice, rate, pitch))
+        thread.daemon = True
+        thread.start()
+
+    def _presynthesize(self, generation, texts, voice, rate, pitch):
+        for text in texts:
+            if generation != self._generation:
+                return  # superseded
+            self.synthesize(text, voice, rate, pitch)
+
+    def _prune(self):
+        try:
+            names = [name for name in os.listdir(self._path)
+                     if name.startswith('tts-')]
+            now = time.time()
+            paths = []
+            for name in names:
+                path = os.path.join(self._path, name)
+                if not name.endswith('.wav') or \
+                        name[:-len('.wav')] + '.ogg' not in names:
+                    paths.append(path)
+                # A WAV is only kept for as long as it might be playing
+                elif now - os.path.getmtime(path) > WAV_KEEP:
+                    os.remove(path)
+            if len(paths) <= MAX_ENTRIES:
+                return
+            paths.sort(key=os.path.getmtime)
+            for path in paths[:len(paths) - MAX_ENTRIES]:
+                os.remove(path)
+        except OSError as e:
+            _logger.error('speech cache %s: %s' % (self._path, e))
+
+
+def _wav(path):
+    ''' The WAV espeak writes for an Ogg file in the cache '''
+    return path[:-len('.ogg')] + '.wav'
+
+
+def _encode(wav_path, ogg_path):
+    ''' Compress a WAV file to Ogg Vorbis; returns True on success '''
+    try:
+        pipeline = Gst.parse_launch(
+            'filesrc name=src ! wavparse ! audioconvert ! vorbisenc ! '
+            'oggmux ! filesink name=sink')
+    except GLib.Error as e:  # an element is missing
+        _logger.error('speech cache: %s' % e)
+        return False
+    pipeline.get_by_name('src').set_property('location', wav_path)
+    pipeline.get_by_name('sink').set_property('location', ogg_path)
+    pipeline.set_state(Gst.State.PLAYING)
+    message = pipeline.get_bus().timed_pop_filtered(
+        ENCODE_TIMEOUT * Gst.SECOND,
+        Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    pipeline.set_state(Gst.State.NULL)
+    if message is None:
+        _logger.error('speech cache: encoding %s timed out' % wav_path)
+        return False
+    if message.type == Gst.MessageType.ERROR:
+        err, debug = message.parse_error()
+        _logger.error('speech cache: %s %s' % (err, debug))
+        return False
+    return True
@@ -29,7 +29,7 @@ methods such as move, hide, set_layer, etc.
 
 There are two classes:
 
-class Sprites maintains a collection of sprites
+class Sprites maintains a collection of sprites, ordered by layer
 class Sprite manages individual sprites within the collection.
 
 Example usage:
@@ -39,7 +39,8 @@ Example usage:
         # Create a new sprite collection associated with your widget
         self.sprite_list = Sprites(widget)
 
-        # Create a "pixbuf" (in this example, from SVG).
+        # Create a "pixbuf" (in this example, from SVG). Pixbufs are
+        # converted to cairo surfaces once, when they are set on a sprite.
         my_pixbuf = svg_str_to_pixbuf("<svg>...some svg code...</svg>")
 
         # Create a sprite at position x1, y1.
@@ -76,10 +77,33 @@ def svg_str_to_pixbuf(svg_string):
 
 '''
 
+import sys
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+
 from gi.repository import GdkPixbuf, Gdk
 from gi.repository import Pango, PangoCairo
 import cairo
 
+from animation import Animation, FRAME
+
+HAVE_NUMPY = False
+try:
+    import numpy
+    HAVE_NUMPY = True
+except ImportError:
+    pass
+
+CELL_SIZE = 64  # size of the squares in the hit-testing grid
+MASK_STEP = 4  # pixels per alpha-mask cell, in each direction
+MASK_THRESHOLD = 32  # alpha below this does not count as a hit
+# Offset of the alpha byte in a native-endian cairo ARGB32 pixel
+_ALPHA = 3 if sys.byteorder == 'little' else 0
+TWEEN_TIME = 250  # ms for a page transition
+STATS_WINDOW = 600  # most recent samples kept by FrameStats
+
 
 class Sprites:
     ''' A class for the list of sprites and everything they share in common '''
@@ -88,52 +112,321 @@ class Sprites:
         ''' Initialize an empty array of sprites '''
         self.cr = None
         self.widget = widget
-        self.list = []
+        self._layers = {}  # layer -> {sprite: None}, bottom to top
+        self._layer_keys = []  # sorted layers in self._layers
+        self._count = 0
+        self._seq = 0  # stacking order within a layer
+        self._grid = {}  # (column, row) -> sprites in the list overlapping
+        self._retained_layer = None  # layers at or below are kept offscreen
+        self._background = None
+        self._retained = None  # [(rect, surface)] holding those layers
+        self._retained_dirty = True
+        self._batch_depth = 0
+        self._batch_damage = []  # rects to redraw when the batch closes
+        self._batch_moves = {}  # sprite -> in the list, in order of change
+        self._batch_grid = {}  # sprites whose grid cells are out of date
+        self._tweens = []
+        self.stats = None  # FrameStats, once enable_stats is called
+
+    def enable_stats(self, window=STATS_WINDOW):
+        ''' Start recording how the sprites are drawn in self.stats '''
+        if self.stats is None:
+            self.stats = FrameStats(window)
+        return self.stats
 
     def set_cairo_context(self, cr):
         ''' Cairo context may be set or reset after __init__ '''
         self.cr = cr
 
+    def set_retained_layer(self, layer, background=None):
+        ''' Keep the sprites at or below layer in offscreen surfaces that
+        are only redrawn when one of them changes. background(cr) is drawn
+        underneath them on every expose. Use None to turn this off. '''
+        self._retained_layer = layer
+        self._background = background
+        self.invalidate_retained()
+
+    def invalidate_retained(self):
+        ''' Redraw the retained layers on the next expose '''
+        self._retained_dirty = True
+
+    def sprite_changed(self, spr):
+        ''' Called when the look or place of a sprite changes '''
+        if self._retained_layer is not None and \
+                spr.layer <= self._retained_layer:
+            self._retained_dirty = True
+
+    def _update_retained(self, cr):
+        ''' Bring the offscreen copies of the retained layers up to date.
+        Overlapping sprites share a surface the size of their bounding box,
+        so only the area they cover is kept. '''
+        if not self._retained_dirty:
+            return
+        sprites = []
+        for spr in self:
+            if spr.layer > self._retained_layer:
+                break
+            sprites.append(spr)
+        old = dict(self._retained or [])
+        self._retained = []
+        for box in merge_rects([tuple(spr.rect) for spr in sprites]):
+            box = tuple(int(v) for v in box)
+            surface = old.get(box)
+            if surface is None:
+                surface = cr.get_target().create_similar_image(
+                    cairo.FORMAT_ARGB32, box[2], box[3])
+            offscreen = cairo.Context(surface)
+            offscreen.set_operator(cairo.OPERATOR_CLEAR)
+            offscreen.paint()
+            offscreen.set_operator(cairo.OPERATOR_OVER)
+            offscreen.translate(-box[0], -box[1])
+            for spr in sprites:
+                if intersects(spr.rect, box):
+                    spr.draw(cr=offscreen)
+            self._retained.append((box, surface))
+        self._retained_dirty = False
+
+    @contextmanager
+    def batch(self):
+        ''' Defer redraws and restacking until the outermost batch closes,
+        then queue a single redraw of everything that changed. Until then,
+        the sprite list and hit testing reflect the state before the batch.
+
+        Example usage:
+            with self._sprites.batch():
+                for dot in self._dots:
+                    dot.hide()
+        '''
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self._end_batch()
+
+    def _end_batch(self):
+        moves, self._batch_moves = self._batch_moves, {}
+        for spr, listed in moves.items():
+            self._remove(spr)
+            if listed:
+                self._append(spr)
+        grid, self._batch_grid = self._batch_grid, {}
+        for spr in grid:
+            if spr not in moves:
+                self.update_grid(spr)
+        damage, self._batch_damage = self._batch_damage, []
+        if damage:
+            self.widget.queue_draw_region(cairo.Region(
+                [cairo.RectangleInt(*rect) for rect in damage]))
+
+    def animate(self, duration, update, done=None):
+        ''' Call update(progress) on every frame for duration ms, then
+        done(). Progress comes from the frame clock, so on a slow machine
+        frames are dropped rather than the animation slowed down. '''
+        steps = max(1, int(duration / FRAME))
+
+        def step(n):
+            with self.batch():
+                update(_ease((n + 1.) / steps))
+
+        def finished():
+            self._tweens.remove(animation)
+            with self.batch():
+                update(1.)
+                if done is not None:
+                    done()
+
+        animation = Animation(self.widget, FRAME, steps, step, finished)
+        self._tweens.append(animation)
+        animation.start()
+        return animation
+
+    def finish_tweens(self):
+        ''' Jump to the end of any running animations '''
+        for animation in list(self._tweens):
+            animation.finish()
+
+    def slide(self, old, new, direction=1, duration=TWEEN_TIME):
+        ''' Push old out sideways as new comes in after it. Both sprites
+        must be in the list and share a rect. A direction of 1 moves to the
+        left, as when turning to the next page; -1 moves to the right. '''
+        self.finish_tweens()
+        width = new.rect[2]
+
+        def update(progress):
+            old.set_offset(-direction * width * progress, 0)
+            new.set_offset(direction * width * (1 - progress), 0)
+
+        def done():
+            old.hide()
+            old.set_offset(0, 0)
+            new.set_offset(0, 0)
+
+        update(0.)
+        return self.animate(duration, update, done)
+
+    def crossfade(self, old, new, duration=TWEEN_TIME):
+        ''' Fade new in on top of old, then hide old '''
+        self.finish_tweens()
+
+        def done():
+            old.hide()
+            new.set_alpha(1.)
+
+        new.set_alpha(0.)
+        return self.animate(duration, new.set_alpha, done)
+
+    def queue_draw(self, rect):
+        ''' Ask gtk to redraw an (x, y, w, h) rectangle '''
+        if rect[2] <= 0 or rect[3] <= 0:
+            return
+        if self._batch_depth:
+            self._batch_damage.append(tuple(rect))
+        else:
+            self.widget.queue_draw_area(*rect)
+
+    def normalize_image(self, image):
+        ''' Convert an image into a cairo surface suitable for painting
+        on the widget, so that drawing it is just a blit. '''
+        if isinstance(image, GdkPixbuf.Pixbuf):
+            return Gdk.cairo_surface_create_from_pixbuf(
+                image, 1, self.widget.get_window())
+        return image
+
+    @property
+    def list(self):
+        ''' The visible sprites, bottom to top '''
+        return [spr for spr in self]
+
+    def __iter__(self):
+        for layer in self._layer_keys:
+            for spr in self._layers[layer]:
+                yield spr
+
     def get_sprite(self, i):
         ''' Return a sprint from the array '''
-        if i < 0 or i > len(self.list) - 1:
-            return(None)
-        else:
-            return(self.list[i])
+        if i < 0 or i > self._count - 1:
+            return None
+        for spr in self:
+            if i == 0:
+                return spr
+            i -= 1
 
     def length_of_list(self):
         ''' How many sprites are there? '''
-        return(len(self.list))
+        return self._count
 
     def append_to_list(self, spr):
-        ''' Append a new sprite to the end of the list. '''
-        self.list.append(spr)
+        ''' Put a sprite on top of the others in its layer. '''
+        if self._batch_depth:
+            self._batch_moves.pop(spr, None)
+            self._batch_moves[spr] = True
+            self.sprite_changed(spr)
+        else:
+            self._append(spr)
+
+    def _append(self, spr):
+        layer = spr.layer
+        if layer not in self._layers:
+            self._layers[layer] = {}
+            self._layer_keys.insert(bisect_left(self._layer_keys, layer),
+                                    layer)
+        self._layers[layer][spr] = None
+        self._seq += 1
+        spr._seq = self._seq
+        spr._in_layer = layer
+        self._count += 1
+        self.update_grid(spr)
+        self.sprite_changed(spr)
 
     def insert_in_list(self, spr, i):
-        ''' Insert a sprite at position i. '''
-        if i < 0:
-            self.list.insert(0, spr)
-        elif i > len(self.list) - 1:
-            self.list.append(spr)
-        else:
-            self.list.insert(i, spr)
+        ''' Sprites are kept in layer order, so this is the same as
+        append_to_list; i is ignored. '''
+        self.append_to_list(spr)
+
+    def is_stacked(self, spr):
+        ''' Is the sprite visible with nothing in its layer over it? '''
+        if spr._in_layer is None or spr in self._batch_moves or \
+                spr in self._batch_grid:
+            return False
+        for cell in spr._cells:
+            for other in self._grid[cell]:
+                if other._in_layer == spr._in_layer and \
+                        other._seq > spr._seq and \
+                        intersects(other.rect, spr.rect):
+                    return False
+        return True
+
+    def raise_in_layer(self, spr):
+        ''' Put a sprite that is_stacked on top of its layer. It covers
+        nothing there, so hit testing and the pixels are unchanged. '''
+        sprites = self._layers[spr._in_layer]
+        del sprites[spr]
+        sprites[spr] = None
+        self._seq += 1
+        spr._seq = self._seq
 
     def remove_from_list(self, spr):
         ''' Remove a sprite from the list. '''
-        if spr in self.list:
-            self.list.remove(spr)
+        if self._batch_depth:
+            self._batch_moves.pop(spr, None)
+            self._batch_moves[spr] = False
+            self.sprite_changed(spr)
+        else:
+            self._remove(spr)
+
+    def _remove(self, spr):
+        if spr._in_layer is not None:
+            # Empty layers are kept, so the sorted keys never shift.
+            del self._layers[spr._in_layer][spr]
+            spr._in_layer = None
+            self._count -= 1
+            self.update_grid(spr)
+            self.sprite_changed(spr)
+
+    def update_grid(self, spr):
+        ''' Move a sprite to the grid cells under its rect, or out of the
+        grid if it is not in the list '''
+        if self._batch_depth:
+            self._batch_grid[spr] = None
+            return
+        for cell in spr._cells:
+            self._grid[cell].remove(spr)
+            if not self._grid[cell]:
+                del self._grid[cell]
+        spr._cells = []
+        if spr._in_layer is None:
+            return
+        x, y, w, h = spr.rect
+        for column in range(x // CELL_SIZE, (x + w) // CELL_SIZE + 1):
+            for row in range(y // CELL_SIZE, (y + h) // CELL_SIZE + 1):
+                cell = (column, row)
+                if cell not in self._grid:
+                    self._grid[cell] = []
+                self._grid[cell].append(spr)
+                spr._cells.append(cell)
 
     def find_sprite(self, pos):
         ''' Search based on (x, y) position. Return the 'top/first' one. '''
-        list = self.list[:]
-        list.reverse()
-        for spr in list:
+        cell = self._grid.get((int(pos[0]) // CELL_SIZE,
+                               int(pos[1]) // CELL_SIZE))
+        if cell is None:
+            return None
+        top = None
+        for spr in cell:
+            if top is not None:
+                if spr.layer < top.layer:
+                    continue
+                if spr.layer == top.layer and spr._seq < top._seq:
+                    continue
             if spr.hit(pos):
-                return spr
-        return None
+                top = spr
+        return top
 
     def redraw_sprites(self, area=None, cr=None):
-        ''' Redraw the sprites that intersect area. '''
+        ''' Redraw the sprites that intersect area. If no area is given,
+        the damage is read from the clip of the Cairo context. '''
         # I think I need to do this to save Cairo some work
         if cr is None:
             cr = self.cr
@@ -142,50 +435,287 @@ class Sprites:
         if cr is None:
             print('sprites.redraw_sprites: no Cairo context')
             return
-        for spr in self.list:
-            if area is None:
-                spr.draw(cr=cr)
-            else:
-                intersection = spr.rect.intersect(area)
-                if intersection.width > 0 or intersection.height > 0:
+        if self.stats is not None:
+            start = time.perf_counter()
+        if area is None:
+            damage = get_damage(cr)
+        else:
+            damage = [_as_rect(area)]
+        if self._retained_layer is not None:
+            if self._background is not None:
+                self._background(cr)
+            self._update_retained(cr)
+            for box, surface in self._retained:
+                for rect in damage:
+                    if intersects(box, rect):
+                        cr.set_source_surface(surface, box[0], box[1])
+                        cr.rectangle(*box)
+                        cr.fill()
+                        break
+        drawn = skipped = 0
+        for spr in self:
+            if self._retained_layer is not None and \
+                    spr.layer <= self._retained_layer:
+                continue
+            for rect in damage:
+                if intersects(spr.rect, rect):
                     spr.draw(cr=cr)
+                    drawn += 1
+                    break
+            else:
+                skipped += 1
+        if self.stats is not None:
+            self.stats.record_frame(
+                (time.perf_counter() - start) * 1000, drawn, skipped,
+                sum(int(rect[2] * rect[3]) for rect in damage))
+
+
+def get_damage(cr):
+    ''' Return the clip of a Cairo context as merged (x, y, w, h) '''
+    try:
+        rects = [_as_rect(r) for r in cr.copy_clip_rectangle_list()]
+    except cairo.Error:  # the clip is not a union of rectangles
+        x1, y1, x2, y2 = cr.clip_extents()
+        rects = [(x1, y1, x2 - x1, y2 - y1)]
+    return merge_rects(rects)
+
+
+def merge_rects(rects):
+    ''' Merge rectangles that overlap or touch into their bounding boxes '''
+    merged = []
+    for rect in rects:
+        if rect[2] <= 0 or rect[3] <= 0:
+            continue
+        i = 0
+        while i < len(merged):
+            if intersects(rect, merged[i], touching=True):
+                rect = union(rect, merged.pop(i))
+                i = 0  # the bigger rect may now reach earlier ones
+            else:
+                i += 1
+        merged.append(rect)
+    return merged
+
+
+def intersects(a, b, touching=False):
+    ''' Do two (x, y, w, h) rectangles overlap (or share an edge)? '''
+    if touching:
+        return a[0] <= b[0] + b[2] and b[0] <= a[0] + a[2] and \
+            a[1] <= b[1] + b[3] and b[1] <= a[1] + a[3]
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and \
+        a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+
+def union(a, b):
+    ''' The bounding box of two (x, y, w, h) rectangles '''
+    x = min(a[0], b[0])
+    y = min(a[1], b[1])
+    return (x, y, max(a[0] + a[2], b[0] + b[2]) - x,
+            max(a[1] + a[3], b[1] + b[3]) - y)
+
+
+def _as_rect(area):
+    if hasattr(area, 'width'):
+        return (area.x, area.y, area.width, area.height)
+    return tuple(area)
+
+
+class _Label:
+    ''' The text and attributes of one label on a sprite '''
+    __slots__ = ('text', 'scale', 'rescale', 'horiz_align', 'vert_align',
+                 'x_pos', 'y_pos', 'color', 'layout')
+
+    def __init__(self, like=None):
+        ''' New labels take their attributes from the first one '''
+        self.text = " "
+        if like is None:
+            self.scale = 12
+            self.rescale = True
+            self.horiz_align = "center"
+            self.vert_align = "middle"
+            self.x_pos = None
+            self.y_pos = None
+        else:
+            self.scale = like.scale
+            self.rescale = like.rescale
+            self.horiz_align = like.horiz_align
+            self.vert_align = like.vert_align
+            self.x_pos = like.x_pos
+            self.y_pos = like.y_pos
+        self.color = (0., 0., 0.)
+        self.layout = None  # (key, layout, width, height)
+
+
+class Histogram:
+    ''' The most recent samples of a measurement, counted into buckets '''
+
+    def __init__(self, bounds, window=STATS_WINDOW):
+        ''' bounds are the upper limits of all but the last bucket '''
+        self.bounds = bounds
+        self._samples = deque(maxlen=window)
+        self.total = 0  # samples ever added
+
+    def add(self, value):
+        self._samples.append(value)
+        self.total += 1
+
+    def summary(self):
+        ''' Return count, mean, percentiles and bucket counts as a
+        dictionary '''
+        samples = sorted(self._samples)
+        if not samples:
+            return {'count': 0}
+        buckets = [0] * (len(self.bounds) + 1)
+        for value in samples:
+            buckets[bisect_left(self.bounds, value)] += 1
+        n = len(samples) - 1
+        return {'count': len(samples), 'total': self.total,
+                'mean': sum(samples) / len(samples),
+                'p50': samples[n // 2], 'p95': samples[n * 95 // 100],
+                'max': samples[-1], 'buckets': buckets}
+
+
+class FrameStats:
+    ''' Rolling measurements of redraw_sprites and label layout '''
+
+    def __init__(self, window=STATS_WINDOW):
+        self.histograms = {
+            'frame ms': Histogram((1, 2, 4, 8, 16, 33, 66), window),
+            'sprites drawn': Histogram((0, 1, 2, 4, 8, 16, 32), window),
+            'sprites skipped': Histogram((0, 1, 2, 4, 8, 16, 32), window),
+            'pixels': Histogram((10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6,
+                                 4 * 10 ** 6), window),
+            'layout ms': Histogram((0.1, 0.25, 0.5, 1, 2, 5), window)}
+
+    def record_frame(self, ms, drawn, skipped, pixels):
+        self.histograms['frame ms'].add(ms)
+        self.histograms['sprites drawn'].add(drawn)
+        self.histograms['sprites skipped'].add(skipped)
+        self.histograms['pixels'].add(pixels)
+
+    def record_layout(self, ms):
+        self.histograms['layout ms'].add(ms)
+
+    def summary(self):
+        return dict((name, histogram.summary())
+                    for name, histogram in self.histograms.items())
+
+    def dump(self):
+        ''' Return the summaries as lines of text, for a log or a file '''
+        lines = []
+        for name, histogram in self.histograms.items():
+            summary = histogram.summary()
+            if summary['count'] == 0:
+                lines.append('%s: no samples' % name)
+                continue
+            buckets = ' '.join(
+                '<=%g:%d' % (bound, count) for bound, count in
+                zip(histogram.bounds, summary['buckets']))
+            lines.append(
+                '%s: n=%d mean=%.2f p50=%.2f p95=%.2f max=%.2f %s >%g:%d' %
+                (name, summary['count'], summary['mean'], summary['p50'],
+                 summary['p95'], summary['max'], buckets,
+                 histogram.bounds[-1], summary['buckets'][-1]))
+        return '\n'.join(lines)
+
+
+def _ease(progress):
+    ''' Start quickly and settle gently '''
+    return 1 - (1 - progress) ** 3
+
+
+class AlphaMask:
+    ''' A downsampled record of which parts of an image are opaque '''
+    __slots__ = ('width', 'height', '_step', '_columns', '_bits')
+
+    def __init__(self, surface, step=MASK_STEP):
+        ''' Sample the alpha of an ARGB32 surface at the centre of each
+        step x step cell '''
+        surface.flush()
+        self.width = surface.get_width()
+        self.height = surface.get_height()
+        self._step = step
+        stride = surface.get_stride()
+        data = surface.get_data()
+        xs = [min(x + step // 2, self.width - 1)
+              for x in range(0, self.width, step)]
+        ys = [min(y + step // 2, self.height - 1)
+              for y in range(0, self.height, step)]
+        self._columns = len(xs)
+        if HAVE_NUMPY:
+            pixels = numpy.frombuffer(data, numpy.uint8)[
+                :stride * self.height].reshape(self.height, stride)
+            alpha = pixels[:, _ALPHA:self.width * 4:4]
+            self._bits = (alpha[numpy.ix_(ys, xs)] >=
+                          MASK_THRESHOLD).ravel()
+        else:
+            data = bytes(data)
+            self._bits = bytearray(
+                data[y * stride + x * 4 + _ALPHA] >= MASK_THRESHOLD
+                for y in ys for x in xs)
+
+    def covers(self, x, y):
+        ''' Is (x, y), relative to the image, on an opaque part? '''
+        if x < 0 or y < 0 or x >= self.width or y >= self.height:
+            return False
+        return bool(self._bits[(int(y) // self._step) * self._columns +
+                               int(x) // self._step])
 
 
 class Sprite:
     ''' A class for the individual sprites '''
+    __slots__ = ('_sprites', 'save_xy', 'rect', '_labels', '_fd', '_bold',
+                 '_italic', '_margins', 'layer', 'images', '_dx', '_dy',
+                 'type', '_in_layer', '_seq', '_cells', '_precise', '_masks',
+                 '_alpha', '_offset', '__weakref__')
 
     def __init__(self, sprites, x, y, image):
         ''' Initialize an individual sprite '''
         self._sprites = sprites
         self.save_xy = (x, y)  # remember initial (x, y) position
         self.rect = [int(x), int(y), 0, 0]
-        self._scale = [12]
-        self._rescale = [True]
-        self._horiz_align = ["center"]
-        self._vert_align = ["middle"]
-        self._x_pos = [None]
-        self._y_pos = [None]
+        self._labels = []
         self._fd = None
         self._bold = False
         self._italic = False
-        self._colors = []
         self._margins = [0, 0, 0, 0]
         self.layer = 100
-        self.labels = []
         self.images = []
         self._dx = []  # image offsets
         self._dy = []
         self.type = None
+        self._in_layer = None  # layer we are filed under, unless hidden
+        self._seq = 0
+        self._cells = []  # hit-testing grid cells holding this sprite
+        self._precise = False  # hit test against the alpha of the images
+        self._masks = []  # AlphaMask for each image, built on demand
+        self._alpha = 1.
+        self._offset = (0, 0)  # drawing offset, clipped to rect
         self.set_image(image)
         self._sprites.append_to_list(self)
 
+    @property
+    def labels(self):
+        ''' The text of each label '''
+        return [label.text for label in self._labels]
+
     def set_image(self, image, i=0, dx=0, dy=0):
         ''' Add an image to the sprite. '''
+        if i < len(self.images) and self.images[i] is image and \
+                self._dx[i] == dx and self._dy[i] == dy:
+            return  # nothing to do
+        shown = self._in_layer is not None
+        if shown:
+            self.inval()  # where the old image was
+        image = self._sprites.normalize_image(image)
+        dx, dy = int(dx), int(dy)
         while len(self.images) < i + 1:
             self.images.append(None)
+            self._masks.append(None)
             self._dx.append(0)
             self._dy.append(0)
         self.images[i] = image
+        self._masks[i] = None
         self._dx[i] = dx
         self._dy[i] = dy
         if hasattr(self.images[i], 'get_width'):
@@ -201,11 +731,17 @@ class Sprite:
                 self.rect[2] = w + dx
             if h + dy > self.rect[3]:
                 self.rect[3] = h + dy
+        self._sprites.update_grid(self)
+        if shown:
+            self.inval()
+        else:
+            self._sprites.sprite_changed(self)
 
     def move(self, pos):
         ''' Move to new (x, y) position '''
         self.inval()
         self.rect[0], self.rect[1] = int(pos[0]), int(pos[1])
+        self._sprites.update_grid(self)
         self.inval()
 
     def move_relative(self, pos):
@@ -213,6 +749,7 @@ class Sprite:
         self.inval()
         self.rect[0] += int(pos[0])
         self.rect[1] += int(pos[1])
+        self._sprites.update_grid(self)
         self.inval()
 
     def get_xy(self):
@@ -229,20 +766,18 @@ class Sprite:
 
     def set_shape(self, image, i=0):
         ''' Set the current image associated with the sprite '''
-        self.inval()
         self.set_image(image, i)
-        self.inval()
 
     def set_layer(self, layer=None):
         ''' Set the layer for a sprite '''
+        if (layer is None or layer == self.layer) and \
+                self._sprites.is_stacked(self):
+            # Nothing in its layer covers it, so nothing needs redrawing
+            self._sprites.raise_in_layer(self)
+            return
         self._sprites.remove_from_list(self)
         if layer is not None:
             self.layer = layer
-        for i in range(self._sprites.length_of_list()):
-            if self.layer < self._sprites.get_sprite(i).layer:
-                self._sprites.insert_in_list(self, i)
-                self.inval()
-                return
         self._sprites.append_to_list(self)
         self.inval()
 
@@ -251,36 +786,30 @@ class Sprite:
         self._extend_labels_array(i)
         if type(new_label) is str or type(new_label) is str:
             # pango doesn't like nulls
-            self.labels[i] = new_label.replace("\0", " ")
+            self._labels[i].text = new_label.replace("\0", " ")
         else:
-            self.labels[i] = str(new_label)
+            self._labels[i].text = str(new_label)
         self.inval()
 
     def set_margins(self, l=0, t=0, r=0, b=0):
         ''' Set the margins for drawing the label '''
         self._margins = [l, t, r, b]
-
-    def _extend_colors_array(self, i):
-        while len(self._colors) < i + 1:
-            self._colors.append([0., 0., 0.])
+        self._sprites.sprite_changed(self)
 
     def _extend_labels_array(self, i):
         ''' Append to the labels attribute list '''
         if self._fd is None:
             self.set_font('Sans')
-        while len(self.labels) < i + 1:
-            self.labels.append(" ")
-            self._scale.append(self._scale[0])
-            self._rescale.append(self._rescale[0])
-            self._horiz_align.append(self._horiz_align[0])
-            self._vert_align.append(self._vert_align[0])
-            self._x_pos.append(self._x_pos[0])
-            self._y_pos.append(self._y_pos[0])
-        self._extend_colors_array(i)
+        while len(self._labels) < i + 1:
+            if self._labels:
+                self._labels.append(_Label(self._labels[0]))
+            else:
+                self._labels.append(_Label())
 
     def set_font(self, font):
         ''' Set the font for a label '''
         self._fd = Pango.FontDescription(font)
+        self._sprites.sprite_changed(self)
 
     def set_label_color(self, rgb, i=0):
         ''' Set the font color for a label '''
@@ -292,22 +821,25 @@ class Sprite:
         if rgb.lower() in COLORTABLE:
             rgb = COLORTABLE[rgb.lower()]
         # Convert from '#RRGGBB' to floats
-        self._extend_colors_array(i)
-        self._colors[i] = [int('0x' + rgb[1:3], 16) / 256.,
-                           int('0x' + rgb[3:5], 16) / 256.,
-                           int('0x' + rgb[5:7], 16) / 256.]
+        self._extend_labels_array(i)
+        self._labels[i].color = (int('0x' + rgb[1:3], 16) / 256.,
+                                 int('0x' + rgb[3:5], 16) / 256.,
+                                 int('0x' + rgb[5:7], 16) / 256.)
+        self._sprites.sprite_changed(self)
         return
 
     def set_label_attributes(self, scale, rescale=True, horiz_align="center",
                              vert_align="middle", x_pos=None, y_pos=None, i=0):
         ''' Set the various label attributes '''
         self._extend_labels_array(i)
-        self._scale[i] = scale
-        self._rescale[i] = rescale
-        self._horiz_align[i] = horiz_align
-        self._vert_align[i] = vert_align
-        self._x_pos[i] = x_pos
-        self._y_pos[i] = y_pos
+        label = self._labels[i]
+        label.scale = scale
+        label.rescale = rescale
+        label.horiz_align = horiz_align
+        label.vert_align = vert_align
+        label.x_pos = x_pos
+        label.y_pos = y_pos
+        self._sprites.sprite_changed(self)
 
     def hide(self):
         ''' Hide a sprite '''
@@ -321,10 +853,22 @@ class Sprite:
     def inval(self):
         ''' Invalidate a region for gtk '''
         # self._sprites.window.invalidate_rect(self.rect, False)
-        self._sprites.widget.queue_draw_area(self.rect[0],
-                                             self.rect[1],
-                                             self.rect[2],
-                                             self.rect[3])
+        self._sprites.sprite_changed(self)
+        self._sprites.queue_draw(self.rect)
+
+    def set_alpha(self, alpha):
+        ''' Set the opacity the sprite is drawn with '''
+        if alpha != self._alpha:
+            self._alpha = alpha
+            self.inval()
+
+    def set_offset(self, dx, dy):
+        ''' Draw the sprite shifted by (dx, dy), but only within its own
+        rect. Unlike move, this leaves hit testing alone. '''
+        offset = (int(dx), int(dy))
+        if offset != self._offset:
+            self._offset = offset
+            self.inval()
 
     def draw(self, cr=None):
         ''' Draw the sprite (and label) '''
@@ -333,29 +877,43 @@ class Sprite:
         if cr is None:
             print('sprite.draw: no Cairo context.')
             return
+        if self._alpha <= 0:
+            return
+        if self._alpha >= 1 and self._offset == (0, 0):
+            self._draw(cr)
+            return
+        cr.save()
+        cr.rectangle(*self.rect)
+        cr.clip()
+        cr.translate(*self._offset)
+        if self._alpha < 1:
+            cr.push_group()
+            self._draw(cr)
+            cr.pop_group_to_source()
+            cr.paint_with_alpha(self._alpha)
+        else:
+            self._draw(cr)
+        cr.restore()
+
+    def _draw(self, cr):
         for i, img in enumerate(self.images):
-            if isinstance(img, GdkPixbuf.Pixbuf):
-                Gdk.cairo_set_source_pixbuf(cr, img,
-                                            self.rect[0] + self._dx[i],
-                                            self.rect[1] + self._dy[i])
-                cr.rectangle(self.rect[0] + self._dx[i],
-                             self.rect[1] + self._dy[i],
-                             self.rect[2],
-                             self.rect[3])
-                cr.fill()
-            elif type(img) == cairo.ImageSurface:
-                cr.set_source_surface(img, self.rect[0] + self._dx[i],
-                                      self.rect[1] + self._dy[i])
-                cr.rectangle(self.rect[0] + self._dx[i],
-                             self.rect[1] + self._dy[i],
-                             self.rect[2],
-                             self.rect[3])
-                cr.fill()
-            else:
-                print('sprite.draw: source not a pixbuf (%s)' % (type(img)))
-        if len(self.labels) > 0:
+            if img is None:
+                continue
+            cr.set_source_surface(img, self.rect[0] + self._dx[i],
+                                  self.rect[1] + self._dy[i])
+            cr.rectangle(self.rect[0] + self._dx[i],
+                         self.rect[1] + self._dy[i],
+                         self.rect[2],
+                         self.rect[3])
+            cr.fill()
+        if self._labels:
             self.draw_label(cr)
 
+    def set_precise_hit(self, precise=True):
+        ''' Only count hits on the opaque parts of the images, rather than
+        anywhere in the bounding box '''
+        self._precise = precise
+
     def hit(self, pos):
         ''' Is (x, y) on top of the sprite? '''
         x, y = pos
@@ -367,7 +925,27 @@ class Sprite:
             return False
         if y > self.rect[1] + self.rect[3]:
             return False
-        return True
+        if not self._precise:
+            return True
+        for i in range(len(self.images)):
+            mask = self._get_mask(i)
+            if mask is None:
+                if self.images[i] is not None:
+                    return True  # no alpha to go by
+            elif mask.covers(x - self.rect[0] - self._dx[i],
+                             y - self.rect[1] - self._dy[i]):
+                return True
+        return False
+
+    def _get_mask(self, i):
+        ''' Return the alpha mask of an image, building it the first time
+        it is needed '''
+        if self._masks[i] is None:
+            image = self.images[i]
+            if isinstance(image, cairo.ImageSurface) and \
+                    image.get_format() == cairo.FORMAT_ARGB32:
+                self._masks[i] = AlphaMask(image)
+        return self._masks[i]
 
     def draw_label(self, cr):
         ''' Draw the label based on its attributes '''
@@ -375,61 +953,82 @@ class Sprite:
         if my_width < 0:
             my_width = 0
         my_height = self.rect[3] - self._margins[1] - self._margins[3]
-        for i in range(len(self.labels)):
-            pl = PangoCairo.create_layout(cr)
-            pl.set_text(str(self.labels[i]), -1)
-            self._fd.set_size(int(self._scale[i] * Pango.SCALE))
-            pl.set_font_description(self._fd)
-            w = pl.get_size()[0] / Pango.SCALE
-            if w > my_width:
-                if self._rescale[i]:
-                    self._fd.set_size(
-                        int(self._scale[i] * Pango.SCALE * my_width / w))
-                    pl.set_font_description(self._fd)
-                    w = pl.get_size()[0] / Pango.SCALE
-                else:
-                    j = len(self.labels[i]) - 1
-                    while(w > my_width and j > 0):
-                        pl.set_text(
-                            "…" + self.labels[i][len(self.labels[i]) - j:], -1)
-                        self._fd.set_size(int(self._scale[i] * Pango.SCALE))
-                        pl.set_font_description(self._fd)
-                        w = pl.get_size()[0] / Pango.SCALE
-                        j -= 1
-            if self._x_pos[i] is not None:
-                x = int(self.rect[0] + self._x_pos[i])
-            elif self._horiz_align[i] == "center":
+        for label in self._labels:
+            pl, w, h = self._get_label_layout(cr, label, my_width)
+            if label.x_pos is not None:
+                x = int(self.rect[0] + label.x_pos)
+            elif label.horiz_align == "center":
                 x = int(self.rect[0] + self._margins[0] + (my_width - w) / 2)
-            elif self._horiz_align[i] == 'left':
+            elif label.horiz_align == 'left':
                 x = int(self.rect[0] + self._margins[0])
             else:  # right
                 x = int(self.rect[0] + self.rect[2] - w - self._margins[2])
-            h = pl.get_size()[1] / Pango.SCALE
-            if self._y_pos[i] is not None:
-                y = int(self.rect[1] + self._y_pos[i])
-            elif self._vert_align[i] == "middle":
+            if label.y_pos is not None:
+                y = int(self.rect[1] + label.y_pos)
+            elif label.vert_align == "middle":
                 y = int(self.rect[1] + self._margins[1] + (my_height - h) / 2)
-            elif self._vert_align[i] == "top":
+            elif label.vert_align == "top":
                 y = int(self.rect[1] + self._margins[1])
             else:  # bottom
                 y = int(self.rect[1] + self.rect[3] - h - self._margins[3])
             cr.save()
             cr.translate(x, y)
-            cr.set_source_rgb(self._colors[i][0], self._colors[i][1],
-                              self._colors[i][2])
+            cr.set_source_rgb(*label.color)
             PangoCairo.update_layout(cr, pl)
             PangoCairo.show_layout(cr, pl)
             cr.restore()
 
+    def _get_label_layout(self, cr, label, my_width):
+        ''' Return the layout for a label and its size. The layout is
+        only rebuilt when the text, font, scale or width changes. '''
+        key = (label.text, self._fd, label.scale, label.rescale, my_width)
+        if label.layout is not None and label.layout[0] == key:
+            return label.layout[1:]
+        stats = self._sprites.stats
+        if stats is not None:
+            start = time.perf_counter()
+
+        text = str(label.text)
+        pl = PangoCairo.create_layout(cr)
+        pl.set_text(text, -1)
+        self._fd.set_size(int(label.scale * Pango.SCALE))
+        pl.set_font_description(self._fd)
+        w = pl.get_size()[0] / Pango.SCALE
+        if w > my_width:
+            if label.rescale:
+                self._fd.set_size(
+                    int(label.scale * Pango.SCALE * my_width / w))
+                pl.set_font_description(self._fd)
+                w = pl.get_size()[0] / Pango.SCALE
+            elif len(text) > 1:
+                # Find the longest tail of the text that fits after an
+                # ellipsis (or failing that, just the last character).
+                low, high, best = 1, len(text) - 1, 1
+                while low <= high:
+                    j = (low + high) // 2
+                    pl.set_text("…" + text[len(text) - j:], -1)
+                    if pl.get_size()[0] / Pango.SCALE <= my_width:
+                        best = j
+                        low = j + 1
+                    else:
+                        high = j - 1
+                pl.set_text("…" + text[len(text) - best:], -1)
+                w = pl.get_size()[0] / Pango.SCALE
+        h = pl.get_size()[1] / Pango.SCALE
+        label.layout = (key, pl, w, h)
+        if stats is not None:
+            stats.record_layout((time.perf_counter() - start) * 1000)
+        return pl, w, h
+
     def label_width(self, cr=None):
         ''' Calculate the width of a label '''
         if cr is None:
             cr = self._sprites.cr
         max = 0
-        for i in range(len(self.labels)):
+        for label in self._labels:
             pl = PangoCairo.create_layout(cr)
-            pl.set_text(str(self.labels[i]), -1)
-            self._fd.set_size(int(self._scale[i] * Pango.SCALE))
+            pl.set_text(str(label.text), -1)
+            self._fd.set_size(int(label.scale * Pango.SCALE))
             pl.set_font_description(self._fd)
             w = pl.get_size()[0] / Pango.SCALE
             if w > max:
@@ -446,24 +1045,25 @@ class Sprite:
 
     def label_left_top(self):
         ''' Return the upper-left corner of the label safe zone '''
-        return(self._margins[0], self._margins[1])
+        return self._margins[0], self._margins[1]
 
     def get_pixel(self, pos, i=0):
-        ''' Return the pixl at (x, y) '''
+        ''' Return the pixel at (x, y) '''
         x, y = pos
-        x = x - self.rect[0]
-        y = y - self.rect[1]
-        if y > self.images[i].get_height() - 1:
-            return(-1, -1, -1, -1)
-        try:
-            array = self.images[i].get_pixels()
-            if array is not None:
-                offset = (y * self.images[i].get_width() + x) * 4
-                r, g, b, a = ord(array[offset]), ord(array[offset + 1]),\
-                    ord(array[offset + 2]), ord(array[offset + 3])
-                return(r, g, b, a)
-            else:
-                return(-1, -1, -1, -1)
-        except IndexError:
-            print("Index Error: %d %d" % (len(array), offset))
-            return(-1, -1, -1, -1)
+        x = int(x - self.rect[0] - self._dx[i])
+        y = int(y - self.rect[1] - self._dy[i])
+        image = self.images[i]
+        if not isinstance(image, cairo.ImageSurface) or \
+                image.get_format() != cairo.FORMAT_ARGB32:
+            return -1, -1, -1, -1
+        if x < 0 or y < 0 or x >= image.get_width() or \
+                y >= image.get_height():
+            return -1, -1, -1, -1
+        image.flush()
+        offset = y * image.get_stride() + x * 4
+        pixel = bytes(image.get_data()[offset:offset + 4])
+        if _ALPHA == 3:  # B G R A
+            b, g, r, a = pixel
+        else:  # A R G B
+            a, r, g, b = pixel
+        return r, g, b, a
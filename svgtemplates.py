@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026 Sugar Labs
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+'''
+svgtemplates.py compiles SVG documents once into templates with named
+slots, so that variants (recolored images, backgrounds of a given size)
+can be produced without file I/O or string rebuilding.
+
+A slot is written ${name} in generated SVG. Files loaded from disk have
+a single 'color' slot wherever the drawing uses #000000.
+
+Example usage:
+        from svgtemplates import templates
+
+        svg_string = templates.load(path).render(color='#a00000')
+'''
+
+import re
+import threading
+
+import logging
+_logger = logging.getLogger('story-activity')
+
+RECOLOR = '#000000'
+_SLOT = re.compile(r'\$\{(\w+)\}')
+
+
+class SVGTemplate:
+    ''' An SVG document split into literal text and named slots '''
+
+    def __init__(self, text, markers=None):
+        ''' markers maps literal strings in text to slot names '''
+        patterns = [_SLOT.pattern]
+        self._names = {}
+        if markers is not None:
+            for marker, name in markers.items():
+                patterns.append(re.escape(marker))
+                self._names[marker] = name
+        self._parts = []  # literal, slot name, literal, slot name, ...
+        self._defaults = {}
+        start = 0
+        for match in re.finditer('|'.join(patterns), text):
+            self._parts.append(text[start:match.start()])
+            if match.group(1) is not None:
+                name = match.group(1)
+            else:
+                name = self._names[match.group(0)]
+                self._defaults[name] = match.group(0)
+            self._parts.append(name)
+            start = match.end()
+        self._parts.append(text[start:])
+
+    def render(self, **values):
+        ''' Fill in the slots; unfilled marker slots keep their text '''
+        parts = self._parts[:]
+        for i in range(1, len(parts), 2):
+            name = parts[i]
+            if name in values and values[name] is not None:
+                parts[i] = str(values[name])
+            else:
+                parts[i] = self._defaults.get(name, '')
+        return ''.join(parts)
+
+
+class TemplateStore:
+    ''' Compiled templates shared by everyone who draws SVG '''
+
+    def __init__(self):
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def load(self, path):
+        ''' Return the template for an SVG file, reading it only once '''
+        with self._lock:
+            template = self._templates.get(path)
+            if template is None:
+                with open(path, 'r') as fd:
+                    template = SVGTemplate(fd.read(), {RECOLOR: 'color'})
+                self._templates[path] = template
+        return template
+
+    def preload(self, paths):
+        ''' Compile a batch of files up front '''
+        for path in paths:
+            try:
+                self.load(path)
+            except (OSError, UnicodeDecodeError) as e:
+                _logger.error('svg template %s: %s' % (path, e))
+
+    def compile(self, name, text):
+        ''' Return the template registered as name, compiling text once '''
+        with self._lock:
+            template = self._templates.get(name)
+            if template is None:
+                template = SVGTemplate(text)
+                self._templates[name] = template
+        return template
+
+
+templates = TemplateStore()
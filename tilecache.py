@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026 Sugar Labs
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+'''
+tilecache.py keeps rasterized story tiles in a single packed file in the
+activity instance directory, so that they can be mapped straight back
+into cairo.ImageSurfaces rather than re-rendered from SVG. Recently used
+surfaces are also kept in memory by the process-wide surface_cache.
+
+The file is a magic number followed by a sequence of records:
+
+    digest (20 bytes) width height stride (3 x uint32) pixels
+
+where pixels are stride * height bytes of cairo FORMAT_ARGB32 data and
+digest is the SHA-1 of the tile key.
+'''
+
+import os
+import mmap
+import fcntl
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import struct
+import hashlib
+
+import cairo
+
+import logging
+_logger = logging.getLogger('story-activity')
+
+MAGIC = b'STC1'
+RECORD = struct.Struct('<20sIII')
+MAX_CACHE_SIZE = 32 * 1024 * 1024  # start over once the file gets this big
+SURFACE_BUDGET = 16 * 1024 * 1024  # bytes of pixels kept in memory
+
+
+def tile_key(identity, color, size, scale):
+    ''' Digest of everything that determines the pixels of a tile '''
+    key = '%s|%s|%d|%d' % (identity, color, size, scale)
+    return hashlib.sha1(key.encode('utf-8')).digest()
+
+
+class TileCache:
+    ''' A packed, memory-mapped store of rendered tiles. Every Story
+    instance shares the file, so changes to it are made holding a lock
+    file, and it is only ever appended to or replaced: another instance
+    may have it mapped. '''
+
+    def __init__(self, path):
+        self._path = path
+        self._map = None
+        self._inode = None  # of the file that is mapped
+        self._index = {}
+        self._size = 0
+        self._end = 0
+        self._lock = threading.Lock()
+        try:
+            with self._file_lock():
+                # Start over if the file is missing, too big or ends part
+                # way through a record (cut short by a crash)
+                if not self._scan() or self._size > MAX_CACHE_SIZE:
+                    self._reset()
+                    self._scan()
+        except OSError as e:
+            _logger.error('tile cache %s: %s' % (self._path, e))
+
+    @contextmanager
+    def _file_lock(self):
+        ''' Hold the lock, shared by every instance, for changing the
+        cache file '''
+        with open(self._path + '.lock', 'a') as fd:
+            fcntl.flock(fd.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def _reset(self):
+        ''' Replace the cache file with an empty one '''
+        fd, temporary = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self._path)))
+        try:
+            with os.fdopen(fd, 'wb') as new_file:
+                new_file.write(MAGIC)
+            os.replace(temporary, self._path)
+        except OSError:
+            os.remove(temporary)
+            raise
+
+    def _map_file(self):
+        ''' Map the whole cache file as it is now. Returns False if it is
+        missing or not a tile cache. '''
+        self._map = None
+        self._size = 0
+        try:
+            with open(self._path, 'rb') as fd:
+                stat = os.fstat(fd.fileno())
+                self._inode = stat.st_ino
+                self._size = stat.st_size
+                if fd.read(len(MAGIC)) != MAGIC:
+                    return False
+                if self._size > len(MAGIC):
+                    # ACCESS_COPY gives cairo the writable buffer it
+                    # insists on without ever writing back to the file.
+                    self._map = mmap.mmap(fd.fileno(), 0,
+                                          access=mmap.ACCESS_COPY)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            _logger.error('tile cache %s: %s' % (self._path, e))
+            return False
+        return True
+
+    def _scan(self):
+        ''' Map the cache file and index its records. Returns False if it
+        is missing, not a tile cache or ends part way through a record. '''
+        self._index = {}
+        self._end = len(MAGIC)
+        if not self._map_file():
+            return False
+        self._index_records()
+        return self._end == self._size
+
+    def _index_records(self):
+        ''' Index the mapped records that follow self._end '''
+        if self._map is None:
+            return
+        offset = self._end
+        end = len(self._map)
+        while offset + RECORD.size <= end:
+            digest, width, height, stride = RECORD.unpack_from(
+                self._map, offset)
+            offset += RECORD.size
+            if offset + stride * height > end:
+                break  # truncated record
+            self._index[digest] = (offset, width, height, stride)
+            offset += stride * height
+            self._end = offset
+
+    def get(self, digest):
+        ''' Return a surface mapped from the cache, or None '''
+        with self._lock:
+            if digest not in self._index:
+                return None
+            offset, width, height, stride = self._index[digest]
+            if self._map is None or \
+                    offset + stride * height > len(self._map):
+                # Written since the file was last mapped
+                inode = self._inode
+                self._map_file()
+                if self._inode != inode:
+                    # Another instance started the file over
+                    self._scan()
+                    return None
+                if self._map is None or \
+                        offset + stride * height > len(self._map):
+                    return None
+            data = memoryview(self._map)[offset:offset + stride * height]
+        return cairo.ImageSurface.create_for_data(
+            data, cairo.FORMAT_ARGB32, width, height, stride)
+
+    def put(self, digest, surface):
+        ''' Append a rendered ARGB32 surface to the cache '''
+        with self._lock:
+            if digest in self._index:
+                return
+            surface.flush()
+            width = surface.get_width()
+            height = surface.get_height()
+            stride = surface.get_stride()
+            try:
+                with self._file_lock(), open(self._path, 'ab') as fd:
+                    fd.seek(0, os.SEEK_END)
+                    end = fd.tell()
+                    if os.fstat(fd.fileno()).st_ino != self._inode:
+                        self._scan()  # another instance started over
+                    elif end != self._end:
+                        # Other instances have appended their own tiles
+                        self._map_file()
+                        self._index_records()
+                    if self._end != end or end > MAX_CACHE_SIZE or \
+                            digest in self._index:
+                        return
+                    fd.write(RECORD.pack(digest, width, height, stride))
+                    fd.write(bytes(surface.get_data())[:stride * height])
+            except OSError as e:
+                _logger.error('tile cache %s: %s' % (self._path, e))
+                return
+            # It is mapped when it is first read; surfaces handed out
+            # earlier keep the old mapping alive.
+            offset = end + RECORD.size
+            self._index[digest] = (offset, width, height, stride)
+            self._end = offset + stride * height
+
+
+class SurfaceCache:
+    ''' An in-memory LRU cache of surfaces with a byte budget '''
+
+    def __init__(self, budget=SURFACE_BUDGET):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._surfaces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        ''' Return the surface cached for key, or None '''
+        with self._lock:
+            surface = self._surfaces.get(key)
+            if surface is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._surfaces.move_to_end(key)
+            return surface
+
+    def put(self, key, surface):
+        ''' Add a surface, evicting the least recently used ones '''
+        size = _surface_size(surface)
+        with self._lock:
+            if key in self._surfaces:
+                self.size -= _surface_size(self._surfaces.pop(key))
+            if size > self.budget:
+                return
+            self._surfaces[key] = surface
+            self.size += size
+            while self.size > self.budget:
+                old_key, old_surface = self._surfaces.popitem(last=False)
+                self.size -= _surface_size(old_surface)
+                self.evictions += 1
+
+    def discard(self, key):
+        ''' Drop one surface, if it is cached '''
+        with self._lock:
+            if key in self._surfaces:
+                self.size -= _surface_size(self._surfaces.pop(key))
+
+    def clear(self):
+        ''' Drop every surface (the counters are kept) '''
+        with self._lock:
+            self._surfaces.clear()
+            self.size = 0
+
+    def stats(self):
+        ''' Return the cache counters as a dictionary '''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._surfaces),
+                    'bytes': self.size, 'budget': self.budget}
+
+
+def _surface_size(surface):
+    return surface.get_stride() * surface.get_height()
+
+
+surface_cache = SurfaceCache()
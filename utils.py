@@ -10,9 +10,10 @@
 # Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
 
 import os
-from pipes import quote
 from io import StringIO
 
+from speech import speech
+
 import json
 json.dumps
 from json import load as jload
@@ -53,22 +54,15 @@ VOICES = {'af': 'afrikaans', 'cy': 'welsh-test', 'el': 'greek',
           'ru': 'russian_test', 'sv': 'swedish', 'tr': 'turkish'}
 
 
-def speak(text):
-    """ Speak text """
+def get_voice():
+    """ The espeak voice for the current language, or None """
+    return VOICES.get(os.environ.get('LANG', '')[0:2])
+
+
+def speak(text, finished_cb=None):
+    """ Speak text, then call finished_cb() """
 
     if type(text) == float and int(text) == text:
         text = int(text)
-    safetext = '{}'.format(quote(str(text)))
 
-    lang = os.environ['LANG'][0:2]
-    if lang in VOICES:
-        language_option = '-v ' + VOICES[lang]
-    else:
-        language_option = ''
-
-    try:
-        from sugar3.speech import SpeechManager
-        sm = SpeechManager()
-        sm.say_text(text)
-    except ModuleNotFoundError:  # for safety, if sugar's not installed / found [optional]
-        os.system('espeak {} "{}" --stdout | aplay'.format(language_option, str(text)))
+    speech.say(text, get_voice(), finished_cb=finished_cb)